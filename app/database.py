@@ -1,19 +1,136 @@
 # app/database.py
+import os
+import queue
+import asyncio
+import functools
 import sqlite3
 import json
+import zlib
+import html
+import time
+import threading
+import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from app import jsonutil
 
 # データベースファイルのパス
 DB_PATH = Path(__file__).parent.parent / "conversations.db"
 
+# 接続プール / PRAGMA 設定
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# ノードの extra（role / content 以外の項目）の JSON は、このサイズ以上なら zlib で圧縮して BLOB で保存する
+DB_COMPRESS_MIN_BYTES = int(os.getenv("DB_COMPRESS_MIN_BYTES", "512"))
+# ノードの本文（content）も圧縮する場合のサイズの下限（0 = 圧縮しない。既定）
+# DB は 4〜5 割小さくなるが、会話の読み込みで展開が要るため 2 倍ほど遅くなる（scripts/bench_db_compression.py）
+DB_COMPRESS_CONTENT_MIN_BYTES = int(os.getenv("DB_COMPRESS_CONTENT_MIN_BYTES", "0"))
+DB_COMPRESS_LEVEL = int(os.getenv("DB_COMPRESS_LEVEL", "6"))
+# 圧縮した値の先頭に付ける形式マーカー（TEXT の値は従来どおりの非圧縮 JSON）
+_ZLIB_MARKER = b"z"
+
+# 2 文字以下の検索語（trigram で引けない）で調べる会話の数の上限（更新日時の新しい順）
+DB_SEARCH_SCAN_CONVERSATIONS = int(os.getenv("DB_SEARCH_SCAN_CONVERSATIONS", "300"))
+
+_pool: Optional["queue.LifoQueue[sqlite3.Connection]"] = None
+_pool_lock = threading.Lock()
+# DB 処理専用のスレッドプール（接続数と同じ数だけ。async のハンドラからは run_db 経由で使う）
+_executor: Optional[ThreadPoolExecutor] = None
+
+T = TypeVar("T")
+
+# スキーマのバージョン（PRAGMA user_version）
+# 1: ノードを conversation_nodes に正規化して保存
+# 2: 会話一覧用の複合カバリングインデックス（単一列のインデックスは削除）
+# 3: 会話ごとの version 列（書き込みのたびに +1。ETag に使う）と、それを含めたカバリングインデックス
+# 4: ノードの本文も圧縮して保存し、全文検索は展開用のビューを外部コンテンツとして参照する
+# 5: 勤怠の一括出力ジョブの進捗（gunicorn のワーカー間で共有する）
+# 6: 本文の全文検索インデックスを contentless にして、アプリから平文を書き込む（ビュー・トリガーを削除）
+# 7: 一括出力ジョブの最終更新時刻（進捗が止まったまま running のジョブを期限切れにする）
+SCHEMA_VERSION = 7
+
+# 全文検索（FTS5 trigram）が使えるか。ensure_schema / init_db で判定する
+_search_available = False
+
+# 検索結果のハイライト用の区切り文字（エスケープ後に <mark> へ置き換える）
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+def _connect() -> sqlite3.Connection:
+    """WAL + チューニング済み PRAGMA の接続を作る（プールからスレッドをまたいで使う）"""
+    conn = sqlite3.connect(
+        str(DB_PATH),
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
+    # 圧縮した本文をアプリの SQL から読むための関数（スキーマのビュー・トリガーからは使わない。
+    # この関数を登録しない sqlite3 CLI などからも conversation_nodes を書き換えられるように）
+    conn.create_function("unpack_text", 1, _unpack_text, deterministic=True)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def open_pool() -> None:
+    """プロセス内の接続プールを作る（起動時に 1 回。2 回目以降は何もしない）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            return
+        pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        for _ in range(DB_POOL_SIZE):
+            pool.put(_connect())
+        _pool = pool
+        print(f"[DB] Connection pool opened ({DB_POOL_SIZE} connections, WAL)")
+
+def close_pool() -> None:
+    """DB 用スレッドプールを止め、プールの接続をすべて閉じる"""
+    global _pool, _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _pool is None:
+            return
+        while not _pool.empty():
+            _pool.get_nowait().close()
+        _pool = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+        return _executor
+
+async def run_db(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    同期の DB 関数を DB 専用スレッドで実行して結果を待つ
+    SQLite の I/O や大きなツリーの json.dumps / json.loads でイベントループを止めないためのもの
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
 @contextmanager
 def get_db():
-    """データベース接続のコンテキストマネージャー"""
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
+    """データベース接続のコンテキストマネージャー（プールから借りて、終わったら返す）"""
+    if _pool is None:
+        open_pool()
+    pool = _pool
+    try:
+        conn = pool.get(timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    except queue.Empty:
+        raise RuntimeError("Timed out waiting for a database connection")
     try:
         yield conn
         conn.commit()
@@ -21,14 +138,16 @@ def get_db():
         conn.rollback()
         raise
     finally:
-        conn.close()
+        pool.put(conn)
 
 def init_db():
-    """データベースの初期化（テーブル作成）"""
+    """データベースの初期化（テーブル作成とマイグレーション）"""
     with get_db() as conn:
         cursor = conn.cursor()
+        # 複数ワーカーが同時に起動してもマイグレーションが 1 回で済むよう直列化する
+        cursor.execute("BEGIN IMMEDIATE")
 
-        # 会話テーブル
+        # 会話テーブル（conversation_tree にはノード以外の部分 = currentPath などを保存）
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS conversations (
                 id TEXT PRIMARY KEY,
@@ -36,20 +155,473 @@ def init_db():
                 title TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                conversation_tree TEXT NOT NULL
+                conversation_tree TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1
+            )
+        """)
+
+        # ノードテーブル（message の role / content 以外のノードの項目は extra に JSON で保存）
+        # content / extra は大きいものを圧縮して BLOB で保存する（_pack_text / _pack_json）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_nodes (
+                conversation_id TEXT NOT NULL,
+                id TEXT NOT NULL,
+                parent_id TEXT,
+                role TEXT,
+                content TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                extra TEXT NOT NULL,
+                PRIMARY KEY (conversation_id, id)
             )
         """)
 
+        # 勤怠の一括出力ジョブ（どのワーカーに来た進捗の問い合わせにも答えられるよう DB に置く）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS attendance_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                bytes_sent INTEGER NOT NULL DEFAULT 0,
+                errors TEXT NOT NULL DEFAULT '[]',
+                started_at REAL NOT NULL,
+                updated_at REAL,
+                finished_at REAL
+            )
+        """)
+
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < 3:
+            columns = {row["name"] for row in cursor.execute("PRAGMA table_info(conversations)")}
+            if "version" not in columns:
+                cursor.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            # version 列を含めて作り直す
+            cursor.execute("DROP INDEX IF EXISTS idx_user_updated")
+
         # インデックス作成
+        # 一覧取得（user_id で絞って updated_at, id の降順）と一覧の ETag の集計をインデックスだけで返せるようにする
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_user_id ON conversations(user_id)
+            CREATE INDEX IF NOT EXISTS idx_user_updated
+            ON conversations(user_id, updated_at DESC, id DESC, title, created_at, version)
         """)
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_updated_at ON conversations(updated_at)
+            CREATE INDEX IF NOT EXISTS idx_nodes_parent ON conversation_nodes(conversation_id, parent_id)
         """)
 
+        if version < 1:
+            migrated = _migrate_tree_blobs(cursor)
+            print(f"[DB] Migrated {migrated} conversations to conversation_nodes")
+        if version < 2:
+            # idx_user_updated で置き換えられたインデックス
+            cursor.execute("DROP INDEX IF EXISTS idx_user_id")
+            cursor.execute("DROP INDEX IF EXISTS idx_updated_at")
+        if version < 6:
+            # 旧インデックスは content を直接（v4, v5 は unpack_text のビュー・トリガーで）参照しているので作り直す
+            _drop_search_index(cursor)
+        if version < 4 and DB_COMPRESS_CONTENT_MIN_BYTES > 0:
+            packed = _pack_stored_contents(cursor)
+            print(f"[DB] Compressed {packed} node contents")
+        if version < 7:
+            columns = {row["name"] for row in cursor.execute("PRAGMA table_info(attendance_jobs)")}
+            if "updated_at" not in columns:
+                cursor.execute("ALTER TABLE attendance_jobs ADD COLUMN updated_at REAL")
+            cursor.execute("UPDATE attendance_jobs SET updated_at = started_at WHERE updated_at IS NULL")
+        if version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        _init_search_index(cursor)
+
         print("[DB] Database initialized")
 
+def ensure_schema() -> None:
+    """
+    起動時（lifespan）に 1 回呼ぶ。スキーマが最新なら DDL は実行せず、古ければ init_db() でマイグレーションする
+    gunicorn の 2 つ目以降のワーカーは user_version を読むだけで済む
+    """
+    global _search_available
+    with get_db() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        has_search = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_nodes_fts'"
+        ).fetchone() is not None
+    if version == SCHEMA_VERSION and has_search:
+        _search_available = True
+        print(f"[DB] Schema is up to date (version {version})")
+        return
+    init_db()
+
+def _drop_search_index(cursor: sqlite3.Cursor) -> None:
+    global _search_available
+    _search_available = False
+    for trigger in ("conversation_nodes_fts_ai", "conversation_nodes_fts_ad", "conversation_nodes_fts_au"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS conversation_nodes_fts")
+    cursor.execute("DROP VIEW IF EXISTS conversation_nodes_text")
+
+def _pack_stored_contents(cursor: sqlite3.Cursor) -> int:
+    """平文で保存されている本文を _pack_text の形式に書き換える（v4 へのマイグレーション）"""
+    cursor.execute("""
+        SELECT rowid, content FROM conversation_nodes
+        WHERE typeof(content) = 'text' AND length(CAST(content AS BLOB)) >= ?
+    """, (DB_COMPRESS_CONTENT_MIN_BYTES,))
+    updates = []
+    for row in cursor.fetchall():
+        packed = _pack_text(row["content"])
+        if isinstance(packed, bytes):
+            updates.append((packed, row["rowid"]))
+    cursor.executemany("UPDATE conversation_nodes SET content = ? WHERE rowid = ?", updates)
+    return len(updates)
+
+def _init_search_index(cursor: sqlite3.Cursor) -> None:
+    """
+    全文検索用の FTS5（trigram）インデックスを用意する
+    本文は contentless（content=''）のインデックスで、保存時にアプリが展開した平文を書き込む
+    （_index_node_changes。本文は圧縮したまま二重に持たず、スキーマはアプリ独自の SQL 関数に依存しない）
+    タイトルは conversations を外部コンテンツとして参照し、トリガーで同期する
+    アプリ以外から conversation_nodes を書き換えた場合は rebuild_search_index() で作り直す
+    trigram トークナイザが使えない SQLite では検索を無効にして起動を続ける
+    """
+    global _search_available
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_nodes_fts'"
+    ).fetchone()
+    if exists:
+        _search_available = True
+        return
+
+    cursor.execute("SAVEPOINT search_index")
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE conversation_nodes_fts USING fts5(
+                content, content='', tokenize='trigram'
+            )
+        """)
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+                title, content='conversations', content_rowid='rowid', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        cursor.execute("ROLLBACK TO search_index")
+        cursor.execute("RELEASE search_index")
+        _search_available = False
+        print(f"[DB] Full-text search disabled: {e}")
+        return
+
+    for statement in (
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, title) VALUES (new.rowid, new.title);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, title)
+            VALUES ('delete', old.rowid, old.title);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE OF title ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, title)
+            VALUES ('delete', old.rowid, old.title);
+            INSERT INTO conversations_fts(rowid, title) VALUES (new.rowid, new.title);
+        END
+        """,
+    ):
+        cursor.execute(statement)
+
+    # 既存の会話をインデックスに取り込む
+    indexed = _fill_node_index(cursor)
+    cursor.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+    cursor.execute("RELEASE search_index")
+    _search_available = True
+    print(f"[DB] Full-text search index built ({indexed} nodes)")
+
+def _fill_node_index(cursor: sqlite3.Cursor) -> int:
+    """全ノードの本文を展開して conversation_nodes_fts に入れる"""
+    rows = cursor.execute("SELECT rowid, content FROM conversation_nodes WHERE content IS NOT NULL").fetchall()
+    cursor.executemany(
+        "INSERT INTO conversation_nodes_fts(rowid, content) VALUES (?, ?)",
+        [(row["rowid"], _unpack_text(row["content"])) for row in rows],
+    )
+    return len(rows)
+
+def rebuild_search_index() -> bool:
+    """本文の全文検索インデックスを作り直す（アプリ以外のツールでノードを書き換えた後などに使う）"""
+    if not _search_available:
+        return False
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("INSERT INTO conversation_nodes_fts(conversation_nodes_fts) VALUES ('delete-all')")
+            indexed = _fill_node_index(cursor)
+            cursor.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+        print(f"[DB] Full-text search index rebuilt ({indexed} nodes)")
+        return True
+    except Exception as e:
+        print(f"[DB] Error rebuilding search index: {e}")
+        return False
+
+def _node_contents(
+    cursor: sqlite3.Cursor,
+    conversation_id: str,
+    node_ids: Optional[List[str]] = None,
+) -> Dict[int, Union[str, bytes, None]]:
+    """rowid -> 保存されている content（node_ids を省略すると会話の全ノード）"""
+    if node_ids is None:
+        cursor.execute(
+            "SELECT rowid, content FROM conversation_nodes WHERE conversation_id = ?",
+            (conversation_id,),
+        )
+    else:
+        cursor.execute("""
+            SELECT rowid, content FROM conversation_nodes
+            WHERE conversation_id = ? AND id IN (SELECT value FROM json_each(?))
+        """, (conversation_id, json.dumps(node_ids, ensure_ascii=False)))
+    return {row["rowid"]: row["content"] for row in cursor.fetchall()}
+
+def _index_node_changes(
+    cursor: sqlite3.Cursor,
+    before: Dict[int, Union[str, bytes, None]],
+    after: Dict[int, Union[str, bytes, None]],
+) -> None:
+    """
+    書き込みの前後の content（_node_contents）を比べて、変わった行だけ全文検索インデックスを更新する
+    contentless のインデックスからの削除には元の平文が要るので、前の値を展開して渡す
+    """
+    removed = [
+        (rowid, _unpack_text(content)) for rowid, content in before.items()
+        if content is not None and (rowid not in after or after[rowid] != content)
+    ]
+    added = [
+        (rowid, _unpack_text(content)) for rowid, content in after.items()
+        if content is not None and (rowid not in before or before[rowid] != content)
+    ]
+    cursor.executemany(
+        "INSERT INTO conversation_nodes_fts(conversation_nodes_fts, rowid, content) VALUES ('delete', ?, ?)",
+        removed,
+    )
+    cursor.executemany("INSERT INTO conversation_nodes_fts(rowid, content) VALUES (?, ?)", added)
+
+def search_available() -> bool:
+    """全文検索が使えるか（起動時の ensure_schema の後で有効）"""
+    return _search_available
+
+def _migrate_tree_blobs(cursor: sqlite3.Cursor) -> int:
+    """conversation_tree にノードごと入っている（旧形式の）会話を conversation_nodes に移す"""
+    cursor.execute("""
+        SELECT id, conversation_tree
+        FROM conversations
+        WHERE json_type(conversation_tree, '$.nodes') IS NOT NULL
+    """)
+    rows = cursor.fetchall()
+    for row in rows:
+        _store_legacy_tree(cursor, row["id"], row["conversation_tree"])
+    return len(rows)
+
+def _store_legacy_tree(cursor: sqlite3.Cursor, conversation_id: str, tree_json: str) -> None:
+    conversation_tree = json.loads(tree_json)
+    skeleton = {k: v for k, v in conversation_tree.items() if k != "nodes"}
+    cursor.execute(
+        "UPDATE conversations SET conversation_tree = ? WHERE id = ?",
+        (json.dumps(skeleton, ensure_ascii=False), conversation_id),
+    )
+    _replace_nodes(cursor, conversation_id, conversation_tree.get("nodes") or {})
+
+def _ensure_normalized(cursor: sqlite3.Cursor, conversation_id: str) -> None:
+    """ローリングデプロイ中に旧形式で書かれた会話があれば、その場で正規化する"""
+    cursor.execute("""
+        SELECT conversation_tree
+        FROM conversations
+        WHERE id = ? AND json_type(conversation_tree, '$.nodes') IS NOT NULL
+    """, (conversation_id,))
+    row = cursor.fetchone()
+    if row:
+        _store_legacy_tree(cursor, conversation_id, row["conversation_tree"])
+
+def _pack_json(value: Any) -> Union[str, bytes]:
+    """
+    JSON にして、大きければ zlib 圧縮した BLOB（先頭に形式マーカー）にする
+    圧縮しても小さくならない値や小さい値は TEXT のまま（旧形式の行と同じ）
+    """
+    text = json.dumps(value, ensure_ascii=False)
+    raw = text.encode("utf-8")
+    if len(raw) < DB_COMPRESS_MIN_BYTES:
+        return text
+    packed = _ZLIB_MARKER + zlib.compress(raw, DB_COMPRESS_LEVEL)
+    return packed if len(packed) < len(raw) else text
+
+def _pack_text(text: Optional[str]) -> Union[str, bytes, None]:
+    """
+    本文を _pack_json と同じ形式（大きければ zlib 圧縮した BLOB、それ以外は TEXT のまま）にする
+    DB_COMPRESS_CONTENT_MIN_BYTES が 0 なら常に TEXT のまま
+    """
+    if text is None or DB_COMPRESS_CONTENT_MIN_BYTES <= 0:
+        return text
+    raw = text.encode("utf-8")
+    if len(raw) < DB_COMPRESS_CONTENT_MIN_BYTES:
+        return text
+    packed = _ZLIB_MARKER + zlib.compress(raw, DB_COMPRESS_LEVEL)
+    return packed if len(packed) < len(raw) else text
+
+def _unpack_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """_pack_text の逆（SQL 関数 unpack_text としても使う）"""
+    if isinstance(value, bytes):
+        if value[:1] != _ZLIB_MARKER:
+            raise ValueError("Unknown compression format")
+        return zlib.decompress(value[1:]).decode("utf-8")
+    return value
+
+def _unpack_json(value: Union[str, bytes]) -> Any:
+    """_pack_json の逆（TEXT の行はそのまま JSON として読む）"""
+    if isinstance(value, bytes):
+        if value[:1] != _ZLIB_MARKER:
+            raise ValueError("Unknown compression format")
+        return jsonutil.loads(zlib.decompress(value[1:]))
+    return jsonutil.loads(value)
+
+def _split_node(node: Dict[str, Any]) -> Tuple[Optional[str], Union[str, bytes, None], Union[str, bytes]]:
+    """ノード -> (role, 保存用の content, それ以外の項目の JSON)"""
+    extra = dict(node)
+    role = content = None
+    message = node.get("message")
+    if isinstance(message, dict):
+        message = dict(message)
+        if isinstance(message.get("role"), str):
+            role = message.pop("role")
+        if isinstance(message.get("content"), str):
+            content = message.pop("content")
+        extra["message"] = message
+    return role, _pack_text(content), _pack_json(extra)
+
+def _join_node(role: Optional[str], content: Union[str, bytes, None], extra: Union[str, bytes]) -> Dict[str, Any]:
+    """_split_node の逆"""
+    content = _unpack_text(content)
+    node = _unpack_json(extra)
+    message = node.get("message")
+    if isinstance(message, dict):
+        restored: Dict[str, Any] = {}
+        if role is not None:
+            restored["role"] = role
+        if content is not None:
+            restored["content"] = content
+        restored.update(message)
+        node["message"] = restored
+    return node
+
+def _upsert_nodes(
+    cursor: sqlite3.Cursor,
+    conversation_id: str,
+    nodes: Dict[str, Dict[str, Any]],
+    keep_parent: bool = False,
+) -> None:
+    """
+    ノードを追加 / 更新する（内容が変わっていない行は書き換えない）
+    keep_parent=True の場合、親が分からないノードは既存の parent_id を保つ（差分保存用）
+    """
+    node_ids = [str(node_id) for node_id in nodes]
+    before = _node_contents(cursor, conversation_id, node_ids) if _search_available else None
+    parents = _parent_map(nodes)
+    parent_update = "COALESCE(excluded.parent_id, conversation_nodes.parent_id)" if keep_parent else "excluded.parent_id"
+    cursor.executemany(f"""
+        INSERT INTO conversation_nodes (conversation_id, id, parent_id, role, content, extra)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(conversation_id, id) DO UPDATE SET
+            parent_id = {parent_update},
+            role = excluded.role,
+            content = excluded.content,
+            extra = excluded.extra
+        WHERE conversation_nodes.parent_id IS NOT {parent_update}
+           OR conversation_nodes.role IS NOT excluded.role
+           OR conversation_nodes.content IS NOT excluded.content
+           OR conversation_nodes.extra IS NOT excluded.extra
+    """, [
+        (conversation_id, str(node_id), parents.get(str(node_id)), *_split_node(node))
+        for node_id, node in nodes.items()
+    ])
+    if before is not None:
+        _index_node_changes(cursor, before, _node_contents(cursor, conversation_id, node_ids))
+
+def _replace_nodes(cursor: sqlite3.Cursor, conversation_id: str, nodes: Dict[str, Dict[str, Any]]) -> None:
+    """会話のノードを nodes と同じ集合にする（無くなったノードは削除）"""
+    _upsert_nodes(cursor, conversation_id, nodes)
+    kept = json.dumps([str(node_id) for node_id in nodes], ensure_ascii=False)
+    if _search_available:
+        cursor.execute("""
+            SELECT rowid, content FROM conversation_nodes
+            WHERE conversation_id = ?
+              AND id NOT IN (SELECT value FROM json_each(?))
+        """, (conversation_id, kept))
+        _index_node_changes(cursor, {row["rowid"]: row["content"] for row in cursor.fetchall()}, {})
+    cursor.execute("""
+        DELETE FROM conversation_nodes
+        WHERE conversation_id = ?
+          AND id NOT IN (SELECT value FROM json_each(?))
+    """, (conversation_id, kept))
+
+def _load_nodes(
+    cursor: sqlite3.Cursor,
+    conversation_id: str,
+    view: str = "full",
+    node_id: Optional[Any] = None,
+    current_path: Optional[List[Any]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    ノードを読み込む
+    view="full":    全ノード
+    view="path":    node_id を指定した場合は root から node_id まで、無ければ currentPath 上のノード
+    view="subtree": node_id 以下の部分木
+    """
+    if view == "path" and node_id is not None:
+        cursor.execute("""
+            WITH RECURSIVE ancestors(id) AS (
+                SELECT ?
+                UNION
+                SELECT n.parent_id
+                FROM conversation_nodes n JOIN ancestors a ON n.id = a.id
+                WHERE n.conversation_id = ? AND n.parent_id IS NOT NULL
+            )
+            SELECT id, role, content, extra
+            FROM conversation_nodes
+            WHERE conversation_id = ? AND id IN (SELECT id FROM ancestors)
+            ORDER BY rowid
+        """, (str(node_id), conversation_id, conversation_id))
+    elif view == "path":
+        cursor.execute("""
+            SELECT id, role, content, extra
+            FROM conversation_nodes
+            WHERE conversation_id = ? AND id IN (SELECT value FROM json_each(?))
+            ORDER BY rowid
+        """, (conversation_id, json.dumps([str(i) for i in current_path or []], ensure_ascii=False)))
+    elif view == "subtree":
+        cursor.execute("""
+            WITH RECURSIVE subtree(id) AS (
+                SELECT ?
+                UNION
+                SELECT n.id
+                FROM conversation_nodes n JOIN subtree s ON n.parent_id = s.id
+                WHERE n.conversation_id = ?
+            )
+            SELECT id, role, content, extra
+            FROM conversation_nodes
+            WHERE conversation_id = ? AND id IN (SELECT id FROM subtree)
+            ORDER BY rowid
+        """, (str(node_id), conversation_id, conversation_id))
+    else:
+        cursor.execute("""
+            SELECT id, role, content, extra
+            FROM conversation_nodes
+            WHERE conversation_id = ?
+            ORDER BY rowid
+        """, (conversation_id,))
+
+    return {
+        row["id"]: _join_node(row["role"], row["content"], row["extra"])
+        for row in cursor.fetchall()
+    }
+
 def save_conversation(
     conversation_id: str,
     user_id: str,
@@ -80,73 +652,175 @@ def save_conversation(
                 except Exception:
                     title = "新しい会話"
 
-            # 既存の会話があるか確認
-            cursor.execute(
-                "SELECT id FROM conversations WHERE id = ?",
-                (conversation_id,)
-            )
-            exists = cursor.fetchone()
+            skeleton = {k: v for k, v in conversation_tree.items() if k != "nodes"}
+            tree_json = json.dumps(skeleton, ensure_ascii=False)
 
-            tree_json = json.dumps(conversation_tree, ensure_ascii=False)
+            # 新規作成 or 更新を 1 文で（他ユーザーの同じIDの会話は上書きしない）
+            cursor.execute("""
+                INSERT INTO conversations (id, user_id, title, conversation_tree)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    conversation_tree = excluded.conversation_tree,
+                    title = excluded.title,
+                    updated_at = CURRENT_TIMESTAMP,
+                    version = conversations.version + 1
+                WHERE conversations.user_id = excluded.user_id
+            """, (conversation_id, user_id, title, tree_json))
+            if cursor.rowcount == 0:
+                # 他ユーザーの会話なので何もしない
+                return True
 
-            if exists:
-                # 更新
-                cursor.execute("""
-                    UPDATE conversations
-                    SET conversation_tree = ?,
-                        title = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ? AND user_id = ?
-                """, (tree_json, title, conversation_id, user_id))
-            else:
-                # 新規作成
-                cursor.execute("""
-                    INSERT INTO conversations (id, user_id, title, conversation_tree)
-                    VALUES (?, ?, ?, ?)
-                """, (conversation_id, user_id, title, tree_json))
+            # 変わったノードだけが書き換わる
+            _replace_nodes(cursor, conversation_id, conversation_tree.get("nodes") or {})
 
             return True
     except Exception as e:
         print(f"[DB] Error saving conversation: {e}")
         return False
 
-def get_conversation(conversation_id: str, user_id: str) -> Optional[Dict[str, Any]]:
-    """会話を取得"""
+def patch_conversation(
+    conversation_id: str,
+    user_id: str,
+    nodes: Dict[str, Dict[str, Any]],
+    current_path: Optional[List[Any]] = None,
+    title: Optional[str] = None,
+) -> bool:
+    """
+    会話ツリーの差分保存
+    nodes のノードを追加 / 置き換え、current_path と title は指定された場合のみ更新する
+    書き込むのは渡されたノードの行と会話の行だけなので、会話の長さに関係なくほぼ一定のコスト
+    """
+    try:
+        assignments = ["updated_at = CURRENT_TIMESTAMP", "version = version + 1"]
+        params: List[Any] = []
+        if current_path is not None:
+            assignments.append("conversation_tree = json_set(conversation_tree, '$.currentPath', json(?))")
+            params.append(json.dumps(current_path, ensure_ascii=False))
+        if title is not None:
+            assignments.append("title = ?")
+            params.append(title)
+
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE conversations
+                SET {", ".join(assignments)}
+                WHERE id = ? AND user_id = ?
+            """, (*params, conversation_id, user_id))
+            if cursor.rowcount == 0:
+                return False
+
+            _ensure_normalized(cursor, conversation_id)
+            _upsert_nodes(cursor, conversation_id, nodes, keep_parent=True)
+            return True
+    except Exception as e:
+        print(f"[DB] Error patching conversation: {e}")
+        return False
+
+def get_conversation(
+    conversation_id: str,
+    user_id: str,
+    view: str = "full",
+    node_id: Optional[Any] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    会話を取得
+    view / node_id で読み込むノードを絞れる（_load_nodes を参照）
+    """
     try:
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT id, title, created_at, updated_at, conversation_tree
+                SELECT id, title, created_at, updated_at, version, conversation_tree
                 FROM conversations
                 WHERE id = ? AND user_id = ?
             """, (conversation_id, user_id))
 
             row = cursor.fetchone()
             if row:
+                conversation_tree = jsonutil.loads(row["conversation_tree"])
+                # 旧形式（ノードが blob に入っている）ならそのまま返す
+                if "nodes" not in conversation_tree:
+                    nodes = _load_nodes(
+                        cursor,
+                        conversation_id,
+                        view,
+                        node_id,
+                        conversation_tree.get("currentPath"),
+                    )
+                    conversation_tree = {"nodes": nodes, **conversation_tree}
                 return {
                     "id": row["id"],
                     "title": row["title"],
                     "created_at": row["created_at"],
                     "updated_at": row["updated_at"],
-                    "conversation_tree": json.loads(row["conversation_tree"])
+                    "version": row["version"],
+                    "conversation_tree": conversation_tree
                 }
             return None
     except Exception as e:
         print(f"[DB] Error getting conversation: {e}")
         return None
 
-def list_conversations(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-    """ユーザーの会話一覧を取得"""
+def get_conversation_version(conversation_id: str, user_id: str) -> Optional[Tuple[str, int]]:
+    """会話の (created_at, version) だけを返す（ツリーは読まない。条件付き GET 用）"""
     try:
         with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, title, created_at, updated_at
+            row = conn.execute("""
+                SELECT created_at, version
+                FROM conversations
+                WHERE id = ? AND user_id = ?
+            """, (conversation_id, user_id)).fetchone()
+            return (row["created_at"], row["version"]) if row else None
+    except Exception as e:
+        print(f"[DB] Error getting conversation version: {e}")
+        return None
+
+def get_list_version(user_id: str) -> Optional[Tuple[int, Optional[str], int]]:
+    """
+    ユーザーの会話一覧の状態 (件数, 最新の updated_at, version の合計) を返す
+    追加・削除・更新のどれでも変わる。idx_user_updated だけで集計できる
+    """
+    try:
+        with get_db() as conn:
+            row = conn.execute("""
+                SELECT COUNT(*), MAX(updated_at), TOTAL(version)
                 FROM conversations
                 WHERE user_id = ?
-                ORDER BY updated_at DESC
-                LIMIT ?
-            """, (user_id, limit))
+            """, (user_id,)).fetchone()
+            return (row[0], row[1], int(row[2]))
+    except Exception as e:
+        print(f"[DB] Error getting conversation list version: {e}")
+        return None
+
+def list_conversations(
+    user_id: str,
+    limit: int = 50,
+    after: Optional[Tuple[str, str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    ユーザーの会話一覧を取得（updated_at, id の降順）
+    after に前ページ最後の (updated_at, id) を渡すとその続きを返す（キーセットページング）
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            if after is None:
+                cursor.execute("""
+                    SELECT id, title, created_at, updated_at
+                    FROM conversations
+                    WHERE user_id = ?
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ?
+                """, (user_id, limit))
+            else:
+                cursor.execute("""
+                    SELECT id, title, created_at, updated_at
+                    FROM conversations
+                    WHERE user_id = ? AND (updated_at, id) < (?, ?)
+                    ORDER BY updated_at DESC, id DESC
+                    LIMIT ?
+                """, (user_id, after[0], after[1], limit))
 
             rows = cursor.fetchall()
             return [
@@ -162,6 +836,149 @@ def list_conversations(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
         print(f"[DB] Error listing conversations: {e}")
         return []
 
+def _fts_query(terms: List[str]) -> str:
+    """検索語を FTS5 のフレーズの AND にする（ユーザー入力の演算子は解釈させない）"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def _excerpt(text: str, terms: List[str], width: int = 32) -> str:
+    """最初に一致した位置の前後を切り出して一致部分に印を付ける"""
+    lowered = text.lower()
+    hits = [(lowered.find(term.lower()), term) for term in terms]
+    hits = [(pos, term) for pos, term in hits if pos >= 0]
+    if not hits:
+        return text[:width * 2]
+    pos, term = min(hits)
+    start = max(0, pos - width // 2)
+    end = min(len(text), pos + len(term) + width)
+    excerpt = text[start:end]
+    for t in terms:
+        lowered_excerpt = excerpt.lower()
+        out, i = [], 0
+        while True:
+            j = lowered_excerpt.find(t.lower(), i)
+            if j < 0:
+                break
+            out.append(excerpt[i:j] + _MARK_START + excerpt[j:j + len(t)] + _MARK_END)
+            i = j + len(t)
+        excerpt = "".join(out) + excerpt[i:]
+    return ("…" if start > 0 else "") + excerpt + ("…" if end < len(text) else "")
+
+def _mark_snippet(snippet: Optional[str]) -> str:
+    """スニペットを HTML エスケープし、一致部分だけを <mark> で囲む"""
+    escaped = html.escape(snippet or "")
+    return escaped.replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+def _search_fts(cursor: sqlite3.Cursor, user_id: str, terms: List[str], limit: int) -> List[Dict[str, Any]]:
+    """
+    FTS5 で検索する。まず bm25 だけで順位を付けて会話ごとの最良の 1 件に絞り、
+    スニペット（本文の展開を伴う）は最後に残った limit 件だけで作る
+    本文のインデックスは contentless で snippet() が使えないため、スニペットは _excerpt で作る
+    """
+    match = _fts_query(terms)
+    # タイトル一致は本文一致より優先（bm25 は小さいほど関連度が高い）
+    cursor.execute("""
+        WITH hits AS (
+            SELECT c.id AS conversation_id, NULL AS node_rowid,
+                   bm25(conversations_fts) * 2.0 AS score
+            FROM conversations_fts
+            JOIN conversations c ON c.rowid = conversations_fts.rowid
+            WHERE conversations_fts MATCH ? AND c.user_id = ?
+            UNION ALL
+            SELECT n.conversation_id, n.rowid, bm25(conversation_nodes_fts)
+            FROM conversation_nodes_fts
+            JOIN conversation_nodes n ON n.rowid = conversation_nodes_fts.rowid
+            WHERE conversation_nodes_fts MATCH ?
+              AND n.conversation_id IN (SELECT id FROM conversations WHERE user_id = ?)
+        ),
+        best AS (
+            SELECT conversation_id, node_rowid, MIN(score) AS score
+            FROM hits
+            GROUP BY conversation_id
+        )
+        SELECT b.conversation_id, c.title, c.updated_at, b.node_rowid, n.id AS node_id, n.content
+        FROM best b
+        JOIN conversations c ON c.id = b.conversation_id
+        LEFT JOIN conversation_nodes n ON n.rowid = b.node_rowid
+        ORDER BY b.score, c.updated_at DESC
+        LIMIT ?
+    """, (match, user_id, match, user_id, limit))
+    rows = []
+    for row in cursor.fetchall():
+        text = row["title"] if row["node_rowid"] is None else _unpack_text(row["content"])
+        rows.append({**dict(row), "snippet": _excerpt(text or "", terms)})
+    return rows
+
+def _contains_all(text: Optional[str], terms: List[str]) -> bool:
+    lowered = (text or "").lower()
+    return all(term.lower() in lowered for term in terms)
+
+def _search_recent(cursor: sqlite3.Cursor, user_id: str, terms: List[str], limit: int) -> List[Dict[str, Any]]:
+    """
+    2 文字以下の検索語用。更新日時の新しい会話から順に本文を展開して調べ、limit 件見つかったら終える
+    調べる会話は DB_SEARCH_SCAN_CONVERSATIONS 件まで（それより古い会話は対象外）
+    """
+    conversations = cursor.execute("""
+        SELECT id, title, updated_at
+        FROM conversations
+        WHERE user_id = ?
+        ORDER BY updated_at DESC, id DESC
+        LIMIT ?
+    """, (user_id, DB_SEARCH_SCAN_CONVERSATIONS)).fetchall()
+
+    rows: List[Dict[str, Any]] = []
+    for conversation in conversations:
+        if len(rows) >= limit:
+            break
+        hit = {
+            "conversation_id": conversation["id"],
+            "title": conversation["title"],
+            "updated_at": conversation["updated_at"],
+        }
+        if _contains_all(conversation["title"], terms):
+            rows.append({**hit, "node_id": None, "snippet": _excerpt(conversation["title"], terms)})
+            continue
+        for node in cursor.execute("""
+            SELECT id, content FROM conversation_nodes
+            WHERE conversation_id = ? AND content IS NOT NULL
+            ORDER BY rowid
+        """, (conversation["id"],)).fetchall():
+            text = _unpack_text(node["content"])
+            if _contains_all(text, terms):
+                rows.append({**hit, "node_id": node["id"], "snippet": _excerpt(text, terms)})
+                break
+    return rows
+
+def search_conversations(user_id: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    ユーザーの会話をタイトルとメッセージ本文から全文検索する（1 会話 1 件）
+    3 文字以上の検索語は FTS5（trigram）の MATCH + bm25 の関連度順、
+    2 文字以下を含む場合は trigram で引けないため、直近の会話を更新日時順に調べる
+    """
+    terms = [t for t in query.split() if t]
+    if not terms:
+        return []
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            if all(len(t) >= 3 for t in terms):
+                rows = _search_fts(cursor, user_id, terms, limit)
+            else:
+                rows = _search_recent(cursor, user_id, terms, limit)
+
+            return [
+                {
+                    "conversation_id": row["conversation_id"],
+                    "title": row["title"],
+                    "updated_at": row["updated_at"],
+                    "node_id": row["node_id"],
+                    "snippet": _mark_snippet(row["snippet"]),
+                }
+                for row in rows
+            ]
+    except Exception as e:
+        print(f"[DB] Error searching conversations: {e}")
+        return []
+
 def delete_conversation(conversation_id: str, user_id: str) -> bool:
     """会話を削除"""
     try:
@@ -171,10 +988,232 @@ def delete_conversation(conversation_id: str, user_id: str) -> bool:
                 DELETE FROM conversations
                 WHERE id = ? AND user_id = ?
             """, (conversation_id, user_id))
-            return cursor.rowcount > 0
+            if cursor.rowcount == 0:
+                return False
+            if _search_available:
+                _index_node_changes(cursor, _node_contents(cursor, conversation_id), {})
+            cursor.execute("""
+                DELETE FROM conversation_nodes
+                WHERE conversation_id = ?
+            """, (conversation_id,))
+            return True
     except Exception as e:
         print(f"[DB] Error deleting conversation: {e}")
         return False
 
-# アプリ起動時にデータベースを初期化
-init_db()
+def _node_parent(node: Dict[str, Any]) -> Optional[Any]:
+    for key in ("parentId", "parent_id", "parent"):
+        if node.get(key) is not None:
+            return node[key]
+    return None
+
+def _parent_map(nodes: Dict[str, Any]) -> Dict[str, str]:
+    """ノードID -> 親ノードID（parentId と children のどちらの表現にも対応）"""
+    parents: Dict[str, str] = {}
+    for key, node in nodes.items():
+        for child in node.get("children") or []:
+            parents[str(child)] = str(key)
+    for key, node in nodes.items():
+        parent = _node_parent(node)
+        if parent is not None:
+            parents[str(key)] = str(parent)
+    return parents
+
+def get_conversation_path(conversation_tree: Dict[str, Any], node_id: Any) -> Optional[List[Any]]:
+    """
+    root から node_id までのノードIDのリストを返す
+    currentPath 上にあればそれを切り出し、無ければ親を辿る
+    """
+    nodes = conversation_tree.get("nodes", {})
+    key = str(node_id)
+    if key not in nodes:
+        return None
+
+    current_path = conversation_tree.get("currentPath", [])
+    for i, path_id in enumerate(current_path):
+        if str(path_id) == key:
+            return current_path[:i + 1]
+
+    parents = _parent_map(nodes)
+    path = [nodes[key].get("id", key)]
+    seen = {key}
+    while key in parents and parents[key] not in seen and parents[key] in nodes:
+        key = parents[key]
+        seen.add(key)
+        path.append(nodes[key].get("id", key))
+    return list(reversed(path))
+
+def path_messages(conversation_tree: Dict[str, Any], path: List[Any]) -> List[Dict[str, str]]:
+    """パス上のノードのメッセージを上流に送る形式で返す（メッセージの無い root などは飛ばす）"""
+    nodes = conversation_tree.get("nodes", {})
+    messages = []
+    for node_id in path:
+        message = (nodes.get(str(node_id)) or {}).get("message") or {}
+        if message.get("role") in ("system", "user", "assistant") and message.get("content"):
+            messages.append({"role": message["role"], "content": message["content"]})
+    return messages
+
+def _allocate_node_ids(cursor: sqlite3.Cursor, conversation_id: str, count: int) -> List[Any]:
+    cursor.execute("""
+        SELECT COUNT(*) AS total,
+               SUM(id = '' OR id GLOB '*[^0-9]*') AS non_numeric,
+               MAX(CAST(id AS INTEGER)) AS max_id
+        FROM conversation_nodes
+        WHERE conversation_id = ?
+    """, (conversation_id,))
+    row = cursor.fetchone()
+    if row["total"] and not row["non_numeric"]:
+        start = row["max_id"] + 1
+        return list(range(start, start + count))
+    return [uuid.uuid4().hex for _ in range(count)]
+
+def allocate_node_ids(conversation_id: str, count: int) -> List[Any]:
+    """
+    既存のID体系に合わせて新しいノードIDを払い出す（数値なら連番、それ以外は UUID）
+    書き込みの前に決める仮のID。確定するのは append_conversation_messages の中
+    """
+    with get_db() as conn:
+        return _allocate_node_ids(conn.cursor(), conversation_id, count)
+
+def append_conversation_messages(
+    conversation_id: str,
+    user_id: str,
+    parent_node_id: Any,
+    messages: List[Dict[str, str]],
+    node_ids: List[Any],
+) -> Optional[List[Any]]:
+    """
+    parent_node_id の下にメッセージを 1 本の枝として追加し、currentPath をその末尾に切り替える
+    読み込みから書き込みまでを 1 トランザクションで行い、実際に使ったノードIDを返す（失敗時は None）
+    node_ids（先に払い出した仮のID）が同時の保存で使われていたら、ロックを取った状態で払い出し直す
+    """
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            # 同時保存で更新が失われないよう、読み込みの前に書き込みロックを取る
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT conversation_tree
+                FROM conversations
+                WHERE id = ? AND user_id = ?
+            """, (conversation_id, user_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            _ensure_normalized(cursor, conversation_id)
+
+            # root から親までのノードだけを読んでパスを求める
+            skeleton = json.loads(row["conversation_tree"])
+            skeleton.pop("nodes", None)
+            ancestors = _load_nodes(cursor, conversation_id, "path", parent_node_id)
+            path = get_conversation_path({**skeleton, "nodes": ancestors}, parent_node_id)
+            if path is None:
+                return None
+
+            cursor.execute("""
+                SELECT COUNT(*) FROM conversation_nodes
+                WHERE conversation_id = ? AND id IN (SELECT value FROM json_each(?))
+            """, (conversation_id, json.dumps([str(node_id) for node_id in node_ids])))
+            if cursor.fetchone()[0]:
+                node_ids = _allocate_node_ids(cursor, conversation_id, len(messages))
+                print(f"[DB] Node id conflict while appending to {conversation_id}, reallocated {node_ids}")
+
+            parent = ancestors[str(parent_node_id)]
+            parent_id = path[-1]
+            new_nodes: Dict[str, Dict[str, Any]] = {}
+            for node_id, message in zip(node_ids, messages):
+                if isinstance(parent.get("children"), list):
+                    parent["children"].append(node_id)
+                node = {
+                    "id": node_id,
+                    "parentId": parent_id,
+                    "children": [],
+                    "message": message,
+                }
+                new_nodes[str(node_id)] = node
+                path.append(node_id)
+                parent, parent_id = node, node_id
+
+            # 元の親ノード（children が更新されている）と追加したノードだけを書き込む
+            new_nodes = {str(parent_node_id): ancestors[str(parent_node_id)], **new_nodes}
+            _upsert_nodes(cursor, conversation_id, new_nodes, keep_parent=True)
+            cursor.execute("""
+                UPDATE conversations
+                SET conversation_tree = json_set(conversation_tree, '$.currentPath', json(?)),
+                    updated_at = CURRENT_TIMESTAMP,
+                    version = version + 1
+                WHERE id = ? AND user_id = ?
+            """, (json.dumps(path, ensure_ascii=False), conversation_id, user_id))
+            return list(node_ids)
+    except Exception as e:
+        print(f"[DB] Error appending to conversation: {e}")
+        return None
+
+def create_attendance_job(job_id: str, total: int, started_at: float) -> bool:
+    """勤怠の一括出力ジョブを登録する"""
+    try:
+        with get_db() as conn:
+            conn.execute("""
+                INSERT INTO attendance_jobs (id, status, total, started_at, updated_at)
+                VALUES (?, 'running', ?, ?, ?)
+            """, (job_id, total, started_at, started_at))
+            return True
+    except Exception as e:
+        print(f"[DB] Error creating attendance job: {e}")
+        return False
+
+def update_attendance_job(job_id: str, job: Dict[str, Any]) -> bool:
+    """ジョブの進捗（status / done / failed / bytes_sent / errors / finished_at）を書き込む（updated_at は現在時刻）"""
+    try:
+        with get_db() as conn:
+            conn.execute("""
+                UPDATE attendance_jobs
+                SET status = ?, done = ?, failed = ?, bytes_sent = ?, errors = ?, finished_at = ?, updated_at = ?
+                WHERE id = ?
+            """, (
+                job["status"], job["done"], job["failed"], job["bytes_sent"],
+                json.dumps(job["errors"], ensure_ascii=False), job["finished_at"], time.time(), job_id,
+            ))
+            return True
+    except Exception as e:
+        print(f"[DB] Error updating attendance job: {e}")
+        return False
+
+def get_attendance_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """ジョブの進捗を取得"""
+    try:
+        with get_db() as conn:
+            row = conn.execute("""
+                SELECT status, total, done, failed, bytes_sent, errors, started_at, updated_at, finished_at
+                FROM attendance_jobs
+                WHERE id = ?
+            """, (job_id,)).fetchone()
+            if row is None:
+                return None
+            return {**dict(row), "errors": json.loads(row["errors"])}
+    except Exception as e:
+        print(f"[DB] Error getting attendance job: {e}")
+        return None
+
+def prune_attendance_jobs(finished_before: float, stale_before: float) -> int:
+    """
+    stale_before から進捗の更新がない running のジョブを expired にし（ストリームが読まれない・ワーカーが落ちた）、
+    finished_before より前に終わったジョブを消す。expired の終了時刻は最後に進捗を書いた時刻
+    """
+    try:
+        with get_db() as conn:
+            expired = conn.execute("""
+                UPDATE attendance_jobs
+                SET status = 'expired', finished_at = updated_at
+                WHERE status = 'running' AND updated_at < ?
+            """, (stale_before,)).rowcount
+            if expired:
+                print(f"[DB] Expired {expired} stalled attendance jobs")
+            cursor = conn.execute("""
+                DELETE FROM attendance_jobs
+                WHERE finished_at IS NOT NULL AND finished_at < ?
+            """, (finished_before,))
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[DB] Error pruning attendance jobs: {e}")
+        return 0
@@ -0,0 +1,39 @@
+# app/jsonutil.py
+import json
+from typing import Any, Union
+
+from fastapi.responses import Response
+
+# orjson は任意（入っていなければ標準の json にフォールバック）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data: Union[str, bytes]) -> Any:
+    """JSON を読む（orjson があれば orjson で）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(value: Any) -> bytes:
+    """
+    JSON の UTF-8 バイト列にする（非 ASCII はエスケープしない・区切りの空白なし）
+    orjson で扱えない値（64bit を超える整数など）は標準の json で書く
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    """
+    dict / list をそのまま dumps して返すレスポンス
+    response_model による再検証と jsonable_encoder を通らないので、大きな会話ツリーでも 1 回の書き出しで済む
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -5,25 +5,53 @@ from dotenv import load_dotenv, find_dotenv
 # ① .env を最初に読み込む（親ディレクトリからの起動でも拾えるように）
 load_dotenv(find_dotenv(filename=".env", usecwd=True))
 
+# 起動時間の計測（STARTUP_PROFILE_IMPORTS=true なら以降の import をモジュールごとに記録）
+from app import startup
+startup.install_import_profiler()
+
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from app import database
+from app.middleware import CompressionMiddleware
+from app.services import audio_encode, context, openai_service, voicevox
 from app.routers.chat import router as chat_router
 from app.routers.tts import router as tts_router
 from app.routers.conversations import router as conversations_router
-
-# Temporarily disable attendance feature
-# TODO: Re-enable after fixing openpyxl dependency issue
-attendance_available = False
-
-# # Try to import attendance router, but don't fail if it's not available
-# try:
-#     from app.routers.attendance import router as attendance_router
-#     attendance_available = True
-# except Exception as e:
-#     print(f"Warning: Attendance router not available: {e}")
-#     attendance_available = False
-
-app = FastAPI()
+# openpyxl は Excel を openpyxl で作るときだけ読み込むので、ここでは読み込まれない
+from app.routers import attendance
+from app.routers.attendance import router as attendance_router
+
+startup.mark("imports")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 上流 (OpenAI / VOICEVOX) への共有 HTTP クライアントと DB 接続プールをワーカー起動時に作成し、終了時に閉じる
+    openai_service.get_client()
+    voicevox.get_client()
+    with startup.phase("db.open_pool"):
+        database.open_pool()
+    # スキーマが最新なら user_version を確認するだけ（マイグレーションは最初のワーカーで 1 回）
+    with startup.phase("db.ensure_schema"):
+        await asyncio.to_thread(database.ensure_schema)
+    # tokenizer の読み込み（初回はダウンロードを伴う）でイベントループを止めない
+    with startup.phase("context.load_tokenizer"):
+        await asyncio.to_thread(context.load_tokenizer)
+    # opus / mp3 の変換に使う ffmpeg とエンコーダーの確認（無ければ警告を出す）
+    with startup.phase("audio_encode.check_encoders"):
+        await audio_encode.check_encoders()
+    startup.finish()
+    yield
+    await openai_service.close_client()
+    await voicevox.close_client()
+    await asyncio.to_thread(attendance.close_pool)
+    database.close_pool()
+
+app = FastAPI(lifespan=lifespan)
+
+# JSON レスポンスを Accept-Encoding に応じて br / gzip で圧縮（ストリーミングは対象外）
+app.add_middleware(CompressionMiddleware)
 
 # ② CORS 設定（.env の FRONTEND_ORIGIN を利用）
 # カンマ区切りで複数のオリジンをサポート
@@ -36,23 +64,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 別オリジンのフロントエンドの JS から読むレスポンスヘッダー（ページング・条件付き GET・チャットのノードID・一括出力のジョブ）
+    expose_headers=["X-Next-Cursor", "ETag", "X-Job-Id", "X-User-Node-Id", "X-Assistant-Node-Id"],
 )
 
 app.include_router(chat_router)
 app.include_router(tts_router)
 app.include_router(conversations_router)
-
-# Only include attendance router if it's available
-if attendance_available:
-    app.include_router(attendance_router)
-    print("Attendance router enabled")
-else:
-    print("Attendance router disabled")
+app.include_router(attendance_router)
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/health/startup")
+async def health_startup():
+    """このワーカーの起動時間の内訳（import / lifespan の各ステップ、重いモジュールの読み込み状況）"""
+    return startup.report()
+
 @app.get("/api/auth/roles")
 async def get_user_roles(request: Request):
     """
@@ -0,0 +1,118 @@
+# app/middleware.py
+import os
+import gzip
+from typing import Dict, List, Optional
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# brotli は任意（入っていなければ gzip のみ）
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON レスポンスの圧縮設定
+RESPONSE_COMPRESS_ENABLED = os.getenv("RESPONSE_COMPRESS_ENABLED", "true").lower() == "true"
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+# これ以上の大きさはイベントループを止めないよう別スレッドで圧縮する
+RESPONSE_COMPRESS_THREAD_BYTES = int(os.getenv("RESPONSE_COMPRESS_THREAD_BYTES", str(128 * 1024)))
+
+def _supported_encodings() -> List[str]:
+    """サーバー側で使える圧縮方式（優先順）"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encoding（q 値付き）から使う圧縮方式を選ぶ。なければ None"""
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+
+    best: Optional[str] = None
+    best_q = 0.0
+    for encoding in _supported_encodings():
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+
+class CompressionMiddleware:
+    """
+    application/json のレスポンスだけを Accept-Encoding に応じて br / gzip で圧縮する
+    ストリーミング（text/plain, text/event-stream）や音声はそのまま流す
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not RESPONSE_COMPRESS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        start: Optional[Message] = None
+        chunks: List[bytes] = []
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if (
+                    headers.get("content-type", "").startswith("application/json")
+                    and "content-encoding" not in headers
+                ):
+                    # 本文がそろうまで開始メッセージを保留する
+                    start = message
+                    return
+                await send(message)
+                return
+
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            headers = MutableHeaders(raw=list(start["headers"]))
+            headers.add_vary_header("Accept-Encoding")
+            if encoding is not None and len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+                if len(body) >= RESPONSE_COMPRESS_THREAD_BYTES:
+                    compressed = await anyio.to_thread.run_sync(compress, body, encoding)
+                else:
+                    compressed = compress(body, encoding)
+                if len(compressed) < len(body):
+                    body = compressed
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    # 圧縮後は別の表現になるので強い ETag は弱い ETag にする
+                    etag = headers.get("etag")
+                    if etag and not etag.startswith("W/"):
+                        headers["ETag"] = "W/" + etag
+
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
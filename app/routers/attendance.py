@@ -1,13 +1,31 @@
 # app/routers/attendance.py
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime, time
-import openpyxl
+from typing import Any, AsyncGenerator, Deque, Dict, Optional, List, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
+import anyio
+import asyncio
+import io
+import os
+import re
+import time
+import uuid
+import threading
+from collections import deque
 from pathlib import Path
-import tempfile
-import shutil
+
+from app.database import (
+    create_attendance_job,
+    get_attendance_job,
+    prune_attendance_jobs,
+    run_db,
+    update_attendance_job,
+)
+from app.services.xlsx_patch import CellValue, XlsxTemplate
+from app.services.zip_stream import ZipStreamWriter
 
 router = APIRouter(prefix="/api/attendance", tags=["attendance"])
 
@@ -17,6 +35,34 @@ TEMPLATE_PATH = Path(__file__).parent.parent.parent / "template.xlsx"
 if not TEMPLATE_PATH.exists():
     TEMPLATE_PATH = Path(r"C:\Users\Exitotrinity-13\OneDrive\Desktop\ひな型\勤務管理表_2023_12 (4).xlsx")
 
+# Excel 生成はイベントループを止めないようワーカープールで行う（process / thread）
+ATTENDANCE_EXECUTOR = os.getenv("ATTENDANCE_EXECUTOR", "process").lower()
+ATTENDANCE_WORKERS = int(os.getenv("ATTENDANCE_WORKERS", str(os.cpu_count() or 2)))
+# xml: シートの XML を直接書き換える（速い） / openpyxl: ブックを読み込んで保存する
+ATTENDANCE_ENGINE = os.getenv("ATTENDANCE_ENGINE", "xml").lower()
+
+# 一括出力の設定
+ATTENDANCE_BULK_MAX_ITEMS = int(os.getenv("ATTENDANCE_BULK_MAX_ITEMS", "1000"))
+# 生成済みで未送信のものを含めて同時に持つシート数（メモリ使用量の上限になる）
+ATTENDANCE_BULK_WINDOW = int(os.getenv("ATTENDANCE_BULK_WINDOW", str(ATTENDANCE_WORKERS * 2)))
+# 終わったジョブの進捗を残しておく秒数
+ATTENDANCE_JOB_TTL = int(os.getenv("ATTENDANCE_JOB_TTL", "3600"))
+# 進捗を DB に書き込む間隔（秒）。シートごとには書かない
+ATTENDANCE_JOB_PROGRESS_INTERVAL = float(os.getenv("ATTENDANCE_JOB_PROGRESS_INTERVAL", "0.5"))
+# 進捗の更新がこの秒数ないまま running のジョブは expired とみなす（ストリームが読まれない・ワーカーが落ちた）
+ATTENDANCE_JOB_STALE_AFTER = float(os.getenv("ATTENDANCE_JOB_STALE_AFTER", "300"))
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# テンプレートのバイト列（初回に 1 回だけ読む）
+_template_bytes: Optional[bytes] = None
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+# ワーカー側で保持するテンプレート（プール作成時に 1 回だけ渡す）
+_worker_template: Optional[bytes] = None
+_worker_patcher: Optional[XlsxTemplate] = None
+
 class DailyAttendance(BaseModel):
     day: int  # 1-31
     start_time: Optional[str] = None  # "09:00"
@@ -30,11 +76,150 @@ class AttendanceRequest(BaseModel):
     employee_id: str = ""
     attendance_data: List[DailyAttendance]
 
-def time_str_to_excel(time_str: str) -> str:
-    """Convert time string '09:00' to Excel time format '09:00:00'"""
-    if not time_str:
-        return ""
-    return f"{time_str}:00"
+class BulkAttendanceRequest(BaseModel):
+    items: List[AttendanceRequest]
+
+class BulkJobStatus(BaseModel):
+    job_id: str
+    status: str  # running / completed / failed / cancelled / expired
+    total: int
+    done: int
+    failed: int
+    bytes_sent: int
+    elapsed_ms: float
+    sheets_per_sec: float
+    errors: List[Dict[str, Any]]
+
+def time_str_to_excel(time_str: str) -> float:
+    """
+    "09:00" / "9:00:30" を Excel の時刻シリアル値（1 日 = 1.0）に変換する
+    日付をまたぐ勤務のため 24 時以降（"25:00"）も受け付ける
+    """
+    parts = time_str.strip().split(":")
+    if len(parts) not in (2, 3) or not all(p.isdigit() for p in parts):
+        raise ValueError(f"Invalid time: {time_str!r}")
+    hours, minutes = int(parts[0]), int(parts[1])
+    seconds = int(parts[2]) if len(parts) == 3 else 0
+    if minutes >= 60 or seconds >= 60 or hours >= 48:
+        raise ValueError(f"Invalid time: {time_str!r}")
+    return (hours * 3600 + minutes * 60 + seconds) / 86400
+
+def build_cell_values(request: AttendanceRequest) -> Dict[str, CellValue]:
+    """
+    リクエストを「セル参照 -> 値」に変換する（どちらのエンジンもこれをそのまま書き込む）
+    B5 / B6 は「社員番号」「氏名」の見出しなので、値は結合セル D5 / D6 に書く
+    """
+    values: Dict[str, CellValue] = {"B1": request.year, "E1": request.month}
+    if request.employee_id:
+        values["D5"] = request.employee_id
+    if request.employee_name:
+        values["D6"] = request.employee_name
+
+    for daily in request.attendance_data:
+        if daily.day < 1 or daily.day > 31:
+            continue
+        row_index = 10 + daily.day  # Row 11 is day 1
+        if daily.is_holiday:
+            # 休日は時刻を消す
+            values[f"D{row_index}"] = None
+            values[f"E{row_index}"] = None
+            continue
+        if daily.start_time:
+            values[f"D{row_index}"] = time_str_to_excel(daily.start_time)
+        if daily.end_time:
+            values[f"E{row_index}"] = time_str_to_excel(daily.end_time)
+    return values
+
+def load_template() -> bytes:
+    """テンプレートを読み込んでメモリに保持する（2 回目以降はファイルを読まない）"""
+    global _template_bytes
+    if _template_bytes is None:
+        if not TEMPLATE_PATH.exists():
+            raise FileNotFoundError(f"Template file not found at: {TEMPLATE_PATH}")
+        _template_bytes = TEMPLATE_PATH.read_bytes()
+        print(f"[ATTENDANCE] Template loaded: {TEMPLATE_PATH} ({len(_template_bytes)} bytes)")
+    return _template_bytes
+
+def _init_worker(template: bytes) -> None:
+    global _worker_template, _worker_patcher
+    _worker_template = template
+    _worker_patcher = None
+
+def _get_executor() -> Executor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            template = load_template()
+            if ATTENDANCE_EXECUTOR == "thread":
+                _executor = ThreadPoolExecutor(
+                    max_workers=ATTENDANCE_WORKERS,
+                    thread_name_prefix="attendance",
+                    initializer=_init_worker,
+                    initargs=(template,),
+                )
+            else:
+                _executor = ProcessPoolExecutor(
+                    max_workers=ATTENDANCE_WORKERS,
+                    initializer=_init_worker,
+                    initargs=(template,),
+                )
+        return _executor
+
+def close_pool() -> None:
+    """lifespan 終了時にワーカープールを止める"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+def build_with_openpyxl(values: Dict[str, CellValue]) -> bytes:
+    """openpyxl でテンプレートを読み込み、セルに値を書いて保存する"""
+    # openpyxl は読み込みが重いので使うときだけ import する（xml エンジンでは読み込まない）
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(_worker_template))
+    ws = wb.active
+    for ref, value in values.items():
+        ws[ref] = value
+    out = io.BytesIO()
+    wb.save(out)
+    wb.close()
+    return out.getvalue()
+
+def build_with_xml(values: Dict[str, CellValue]) -> bytes:
+    """シートの XML の対象セルだけを書き換える（テンプレートの解析はワーカーごとに 1 回）"""
+    global _worker_patcher
+    if _worker_patcher is None:
+        _worker_patcher = XlsxTemplate(_worker_template)
+    return _worker_patcher.render(values)
+
+def build_attendance_xlsx(values: Dict[str, CellValue]) -> bytes:
+    """
+    テンプレートに勤怠データを書き込んだ xlsx のバイト列を返す（ワーカーで実行する）
+    テンプレートはメモリ上のバイト列から読み、結果もメモリ上に書き出す（一時ファイルは作らない）
+    """
+    if ATTENDANCE_ENGINE == "xml":
+        try:
+            return build_with_xml(values)
+        except (KeyError, ValueError) as e:
+            # テンプレートに対象セルがない・構造が想定外のときは openpyxl で作る
+            print(f"[ATTENDANCE] XML engine fallback to openpyxl: {e!r}")
+    return build_with_openpyxl(values)
+
+async def _ensure_executor() -> Executor:
+    # 初回だけテンプレートの読み込みとプールの作成を行う
+    return _executor or await asyncio.to_thread(_get_executor)
+
+def _reset_executor(e: BaseException) -> None:
+    # ワーカーが落ちた場合は次のリクエストでプールを作り直す
+    global _executor
+    print(f"[ATTENDANCE] Worker pool broken: {e}")
+    with _executor_lock:
+        _executor = None
+
+def attendance_filename(request: AttendanceRequest) -> str:
+    return f"勤務管理表_{request.year}_{request.month:02d}.xlsx"
 
 @router.post("/generate")
 async def generate_attendance_excel(request: AttendanceRequest):
@@ -42,63 +227,192 @@ async def generate_attendance_excel(request: AttendanceRequest):
     勤怠管理表Excelファイルを生成
     """
     print(f"[ATTENDANCE] Received request for {request.year}/{request.month}")
-    print(f"[ATTENDANCE] Template path: {TEMPLATE_PATH}")
-    print(f"[ATTENDANCE] Template exists: {TEMPLATE_PATH.exists()}")
 
     try:
-        # Load template
-        if not TEMPLATE_PATH.exists():
-            error_msg = f"Template file not found at: {TEMPLATE_PATH}"
-            print(f"[ATTENDANCE] ERROR: {error_msg}")
-            raise HTTPException(status_code=500, detail=error_msg)
-
-        wb = openpyxl.load_workbook(TEMPLATE_PATH)
-        ws = wb.active
-
-        # Set year and month
-        ws['B1'] = request.year
-        ws['E1'] = request.month
-
-        # Set employee info (if provided)
-        if request.employee_name:
-            ws['G5'] = request.employee_name  # Assuming this cell for employee name
-        if request.employee_id:
-            ws['B5'] = request.employee_id    # Assuming this cell for employee ID
-
-        # Fill attendance data
-        for daily in request.attendance_data:
-            if daily.day < 1 or daily.day > 31:
-                continue
+        values = build_cell_values(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-            row_index = 10 + daily.day  # Row 11 is day 1
+    try:
+        executor = await _ensure_executor()
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(executor, build_attendance_xlsx, values)
+    except FileNotFoundError as e:
+        print(f"[ATTENDANCE] ERROR: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    except BrokenProcessPool as e:
+        _reset_executor(e)
+        raise HTTPException(status_code=500, detail="Excel worker crashed")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-            if daily.is_holiday:
-                # Clear times for holidays
-                ws[f'D{row_index}'] = ""
-                ws[f'E{row_index}'] = ""
-            else:
-                # Set start/end times
-                if daily.start_time:
-                    ws[f'D{row_index}'] = time_str_to_excel(daily.start_time)
-                if daily.end_time:
-                    ws[f'E{row_index}'] = time_str_to_excel(daily.end_time)
+    return Response(
+        content=content,
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(attendance_filename(request))}"}
+    )
+
+_UNSAFE_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
 
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-            wb.save(tmp.name)
-            tmp_path = tmp.name
+def bulk_member_name(index: int, request: AttendanceRequest) -> str:
+    """ZIP 内のファイル名（連番を付けて重複しないようにする）"""
+    who = _UNSAFE_NAME_RE.sub("_", request.employee_id or request.employee_name).strip()
+    stem = attendance_filename(request)[:-len(".xlsx")]
+    return f"{index + 1:04d}_{stem}_{who}.xlsx" if who else f"{index + 1:04d}_{stem}.xlsx"
 
-        wb.close()
+def _job_snapshot(job_id: str, job: Dict[str, Any]) -> BulkJobStatus:
+    end = job["finished_at"] or time.time()
+    elapsed = end - job["started_at"]
+    return BulkJobStatus(
+        job_id=job_id,
+        status=job["status"],
+        total=job["total"],
+        done=job["done"],
+        failed=job["failed"],
+        bytes_sent=job["bytes_sent"],
+        elapsed_ms=elapsed * 1000,
+        sheets_per_sec=job["done"] / elapsed if elapsed > 0 else 0.0,
+        errors=job["errors"],
+    )
 
-        # Prepare filename
-        filename = f"勤務管理表_{request.year}_{request.month:02d}.xlsx"
+async def stream_bulk_zip(
+    job_id: str,
+    job: Dict[str, Any],
+    executor: Executor,
+    items: List[Tuple[str, Dict[str, CellValue]]],
+) -> AsyncGenerator[bytes, None]:
+    """
+    シートをワーカープールで並列に作り、できた順（リクエストの順）に ZIP のメンバーとして送る
+    同時に持つシートは ATTENDANCE_BULK_WINDOW 件までなので、件数が多くてもメモリは一定
+    失敗したシートは飛ばして errors.txt に記録する
+    進捗は ATTENDANCE_JOB_PROGRESS_INTERVAL ごとと終了時に DB に書く（どのワーカーからでも読める）
+    """
+    loop = asyncio.get_running_loop()
+    saved_at = time.monotonic()
 
-        return FileResponse(
-            tmp_path,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            filename=filename,
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
-        )
+    async def save_progress() -> None:
+        nonlocal saved_at
+        if time.monotonic() - saved_at >= ATTENDANCE_JOB_PROGRESS_INTERVAL:
+            saved_at = time.monotonic()
+            await run_db(update_attendance_job, job_id, job)
 
-    except Exception as e:
+    pending: Deque[Tuple[str, asyncio.Future]] = deque()
+    source = iter(items)
+    writer = ZipStreamWriter()
+    try:
+        while True:
+            while len(pending) < ATTENDANCE_BULK_WINDOW:
+                item = next(source, None)
+                if item is None:
+                    break
+                name, values = item
+                pending.append((name, loop.run_in_executor(executor, build_attendance_xlsx, values)))
+            if not pending:
+                break
+
+            name, future = pending.popleft()
+            try:
+                content = await future
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                job["failed"] += 1
+                job["errors"].append({"name": name, "error": str(e)})
+                print(f"[ATTENDANCE] Bulk item failed ({name}): {e}")
+                await save_progress()
+                continue
+            chunk = writer.add(name, content)
+            job["done"] += 1
+            job["bytes_sent"] += len(chunk)
+            yield chunk
+            await save_progress()
+
+        if job["errors"]:
+            report = "\n".join(f"{err['name']}: {err['error']}" for err in job["errors"])
+            chunk = writer.add("errors.txt", report.encode("utf-8"))
+            job["bytes_sent"] += len(chunk)
+            yield chunk
+        chunk = writer.close()
+        job["bytes_sent"] += len(chunk)
+        yield chunk
+        job["status"] = "completed"
+    except BrokenProcessPool as e:
+        _reset_executor(e)
+        job["status"] = "failed"
+        raise
+    except BaseException:
+        # 切断された場合など。まだ始まっていない生成は取り消す
+        job["status"] = "cancelled"
+        raise
+    finally:
+        for _, future in pending:
+            future.cancel()
+        job["finished_at"] = time.time()
+        with anyio.CancelScope(shield=True):
+            await run_db(update_attendance_job, job_id, job)
+        print(f"[ATTENDANCE] Bulk job {job['status']}: {job['done']}/{job['total']} sheets, {job['failed']} failed")
+
+@router.post("/bulk")
+async def generate_attendance_bulk(request: BulkAttendanceRequest):
+    """
+    複数の勤怠管理表をまとめて生成し、ZIP でストリーミングして返す
+    進捗は X-Job-Id ヘッダのジョブ ID で GET /api/attendance/bulk/{job_id} から取れる
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="items is empty")
+    if len(request.items) > ATTENDANCE_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items (max {ATTENDANCE_BULK_MAX_ITEMS})")
+
+    # 入力の誤りは送信を始める前に 400 で返す
+    items: List[Tuple[str, Dict[str, CellValue]]] = []
+    for index, item in enumerate(request.items):
+        try:
+            items.append((bulk_member_name(index, item), build_cell_values(item)))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"items[{index}]: {e}")
+
+    try:
+        executor = await _ensure_executor()
+    except FileNotFoundError as e:
+        print(f"[ATTENDANCE] ERROR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+    now = time.time()
+    await run_db(prune_attendance_jobs, now - ATTENDANCE_JOB_TTL, now - ATTENDANCE_JOB_STALE_AFTER)
+    job_id = uuid.uuid4().hex
+    job: Dict[str, Any] = {
+        "status": "running",
+        "total": len(items),
+        "done": 0,
+        "failed": 0,
+        "bytes_sent": 0,
+        "started_at": time.time(),
+        "finished_at": None,
+        "errors": [],
+    }
+    if not await run_db(create_attendance_job, job_id, job["total"], job["started_at"]):
+        raise HTTPException(status_code=500, detail="Failed to register the export job")
+    print(f"[ATTENDANCE] Bulk job {job_id} started: {len(items)} sheets")
+
+    filename = f"勤務管理表_{len(items)}件.zip"
+    return StreamingResponse(
+        stream_bulk_zip(job_id, job, executor, items),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+            "X-Job-Id": job_id,
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@router.get("/bulk/{job_id}", response_model=BulkJobStatus)
+async def get_bulk_job(job_id: str):
+    """一括出力ジョブの進捗（別のワーカーが処理しているジョブも DB から読める）"""
+    job = await run_db(get_attendance_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "running" and job["updated_at"] < time.time() - ATTENDANCE_JOB_STALE_AFTER:
+        # DB 上は次の一括出力の掃除で expired になる
+        job = {**job, "status": "expired", "finished_at": job["updated_at"]}
+    return _job_snapshot(job_id, job)
@@ -1,11 +1,48 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import json
+import os
+import time
+import anyio
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List
-from app.services.openai_service import complete_once, stream_completion
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
+from app.database import (
+    allocate_node_ids,
+    append_conversation_messages,
+    get_conversation,
+    get_conversation_path,
+    path_messages,
+    run_db,
+)
+from app.routers.conversations import get_user_id_from_header
+from app.routers.tts import audio_stream_response, sentence_audio
+from app.services.context import fit_context
+from app.services.limiter import UpstreamBusyError, upstream_limiter
+from app.services.openai_service import MODEL, complete_once, stream_events
+from app.services.retry import upstream_stats
+from app.services.tts_stream import iter_sentences
+from app.services.response_cache import (
+    CHAT_CACHE_ENABLED,
+    CHAT_CACHE_MAX_TEMPERATURE,
+    make_cache_key,
+    response_cache,
+)
 
 router = APIRouter(prefix="/api", tags=["chat"])
 
+# SSE モードで delta をまとめて送る窓（バイト数 / ミリ秒のどちらかに達したら flush）
+CHAT_SSE_FLUSH_BYTES = int(os.getenv("CHAT_SSE_FLUSH_BYTES", "48"))
+CHAT_SSE_FLUSH_MS = float(os.getenv("CHAT_SSE_FLUSH_MS", "40"))
+
+# ストリーミングの統計（クライアント切断でキャンセルされた数と、節約できた推定トークン数）
+stream_stats = {
+    "completed": 0,
+    "cancelled": 0,
+    "errors": 0,
+    "tokens_saved": 0,
+}
+
 class Message(BaseModel):
     role: str
     content: str
@@ -15,16 +52,58 @@ class ChatRequest(BaseModel):
     temperature: float = 0.3
     max_tokens: int = 512
 
+class SpeechRequest(ChatRequest):
+    speaker: int = 1  # VOICEVOX の話者（1: ずんだもん）
+
+class ContinueRequest(BaseModel):
+    """保存済みの会話の parent_node_id の下に message を追加して続きを生成する"""
+    conversation_id: str
+    parent_node_id: Union[int, str]
+    message: str
+    temperature: float = 0.3
+    max_tokens: int = 512
+
+def _busy(e: UpstreamBusyError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def _server_timing(timings: Dict[str, float]) -> str:
+    """{"queue_ms": 1.2, ...} -> "queue;dur=1.2, ..." """
+    return ", ".join(f"{name.removesuffix('_ms')};dur={value:.1f}" for name, value in timings.items())
+
+def _use_cache(req: ChatRequest, cache_control: Optional[str]) -> bool:
+    """temperature が CHAT_CACHE_MAX_TEMPERATURE（既定 0）以下のリクエストだけキャッシュする（Cache-Control: no-cache / no-store で無効化）"""
+    if not CHAT_CACHE_ENABLED or req.temperature > CHAT_CACHE_MAX_TEMPERATURE:
+        return False
+    directives = (cache_control or "").lower()
+    return "no-cache" not in directives and "no-store" not in directives
+
 @router.post("/chat")
-async def chat(req: ChatRequest):
+async def chat(
+    req: ChatRequest,
+    response: Response,
+    cache_control: Optional[str] = Header(None),
+):
+    messages = fit_context([m.model_dump() for m in req.messages])
+    # 待ち行列の待ち時間と上流の所要時間（Server-Timing で別々に返す）
+    timings: Dict[str, float] = {}
     try:
-        result = await complete_once(
-            [m.dict() for m in req.messages],
-            req.temperature,
-            req.max_tokens,
-        )
+        if _use_cache(req, cache_control):
+            key = make_cache_key(MODEL, messages, req.temperature, req.max_tokens)
+            result, cache_status = await response_cache.get_or_compute(
+                key,
+                lambda: complete_once(messages, req.temperature, req.max_tokens, timings),
+            )
+        else:
+            response_cache.stats["bypassed"] += 1
+            result = await complete_once(messages, req.temperature, req.max_tokens, timings)
+            cache_status = "bypass"
+        response.headers["X-Cache"] = cache_status.upper()
+        if timings:
+            response.headers["Server-Timing"] = _server_timing(timings)
         # result is dict with 'content' and optionally 'reasoning', 'reasoning_tokens'
         return result
+    except UpstreamBusyError as e:
+        raise _busy(e)
     except RuntimeError as e:
         # APIキー未設定など
         if "API key" in str(e):
@@ -34,22 +113,339 @@ async def chat(req: ChatRequest):
         # その他のエラー（OpenAI APIエラー含む）
         raise HTTPException(status_code=500, detail=f"Upstream error: {str(e)}")
 
-@router.post("/chat/stream")
-async def chat_stream(req: ChatRequest):
-    async def gen():
-        try:
-            async for chunk in stream_completion(
-                [m.dict() for m in req.messages],
-                req.temperature,
-                req.max_tokens,
-            ):
+def _record_stream_end(status: str, emitted_chunks: int, max_tokens: int) -> None:
+    stream_stats[status] += 1
+    if status == "cancelled":
+        # delta 1 チャンク ≒ 1 トークンとして、max_tokens までの残りを節約量とみなす（上限見積り）
+        saved = max(0, max_tokens - emitted_chunks)
+        stream_stats["tokens_saved"] += saved
+        print(f"[CHAT] Stream cancelled by client after {emitted_chunks} chunks (~{saved} tokens saved)")
+
+def _sse(event: Dict[str, Any]) -> str:
+    """イベントを SSE の 1 フレームに変換"""
+    data = {k: v for k, v in event.items() if k not in ("type", "pieces")}
+    return f"event: {event['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _coalesce(events: AsyncIterator[Dict[str, Any]]) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    delta / reasoning の細かい断片を CHAT_SSE_FLUSH_BYTES / CHAT_SSE_FLUSH_MS の窓でまとめる
+    それ以外のイベント（usage など）は溜めている分を吐き出してからそのまま流す
+    """
+    loop = asyncio.get_running_loop()
+    it = events.__aiter__()
+    buf_type: Optional[str] = None
+    buf: List[str] = []
+    buf_bytes = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+
+    def flush() -> Dict[str, Any]:
+        nonlocal buf_type, buf, buf_bytes
+        event = {"type": buf_type, "content": "".join(buf), "pieces": len(buf)}
+        buf_type, buf, buf_bytes = None, [], 0
+        return event
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            if buf:
+                # 次の断片を待つのは窓の残り時間まで。間に合わなければ先に吐き出す
+                done, _ = await asyncio.wait({pending}, timeout=max(0.0, deadline - loop.time()))
+                if not done:
+                    yield flush()
+                    continue
+            task, pending = pending, None
+            try:
+                event = await task
+            except StopAsyncIteration:
+                break
+
+            if event["type"] not in ("delta", "reasoning"):
+                if buf:
+                    yield flush()
+                yield event
+                continue
+
+            if buf and buf_type != event["type"]:
+                yield flush()
+            if not buf:
+                buf_type = event["type"]
+                deadline = loop.time() + CHAT_SSE_FLUSH_MS / 1000
+            buf.append(event["content"])
+            buf_bytes += len(event["content"].encode("utf-8"))
+            if buf_bytes >= CHAT_SSE_FLUSH_BYTES:
+                yield flush()
+
+        if buf:
+            yield flush()
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        await events.aclose()
+
+async def _replay(
+    first: Optional[Dict[str, Any]],
+    error: Optional[Exception],
+    rest: AsyncGenerator[Dict[str, Any], None],
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """先読みした最初のイベント（またはエラー）を返してから残りを流す"""
+    try:
+        if error is not None:
+            raise error
+        if first is not None:
+            yield first
+            async for event in rest:
+                yield event
+    finally:
+        await rest.aclose()
+
+async def _prefetch(upstream: AsyncGenerator[Dict[str, Any], None]) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    レスポンスヘッダを送る前に最初のイベントまで進める
+    上流の混雑 (UpstreamBusyError) はそのまま送出して 503 で返し、
+    それ以外のエラーは従来どおりストリーム内で返すために持ち越す
+    """
+    try:
+        first = await upstream.__anext__()
+    except StopAsyncIteration:
+        return _replay(None, None, upstream)
+    except UpstreamBusyError:
+        raise
+    except Exception as e:
+        return _replay(None, e, upstream)
+    return _replay(first, None, upstream)
+
+# ストリーム終了時に (status, 生成された本文) を受け取るコールバック
+# クライアントに送るイベント（保存結果など）を返せる。切断後に呼ばれた場合は送られない
+OnFinish = Callable[[str, str], Awaitable[Optional[Dict[str, Any]]]]
+
+def _finish_chunk(event: Dict[str, Any], sse: bool) -> Optional[str]:
+    """on_finish のイベントを送る形にする（text/plain ではエラーだけを従来どおり ERROR: で送る）"""
+    if sse:
+        return _sse(event)
+    if event["type"] == "error":
+        return f"ERROR: {event['message']}"
+    return None
+
+async def _stream_body(
+    request: Request,
+    upstream: AsyncGenerator[Dict[str, Any], None],
+    max_tokens: int,
+    sse: bool,
+    on_finish: Optional[OnFinish] = None,
+) -> AsyncGenerator[str, None]:
+    events = _coalesce(upstream) if sse else upstream
+    emitted = 0
+    content: List[str] = []
+    # break / CancelledError / GeneratorExit で抜けた場合は "cancelled" のまま
+    status = "cancelled"
+    finished = False
+
+    async def finish() -> Optional[str]:
+        # on_finish は 1 回だけ呼ぶ（送信中なら結果をストリームの最後に送り、切断後なら finally で呼ぶ）
+        nonlocal finished
+        if on_finish is None or finished:
+            return None
+        finished = True
+        with anyio.CancelScope(shield=True):
+            event = await on_finish(status, "".join(content))
+        return _finish_chunk(event, sse) if event is not None else None
+
+    try:
+        async for event in events:
+            # クライアントが切断していたら上流の生成を打ち切る
+            if await request.is_disconnected():
+                break
+            if event["type"] in ("delta", "reasoning"):
+                emitted += event.get("pieces", 1)
+            if event["type"] == "delta" and on_finish is not None:
+                content.append(event["content"])
+            if sse:
+                yield _sse(event)
+            elif event["type"] == "delta":
+                yield event["content"]
+        else:
+            status = "completed"
+            chunk = await finish()
+            if chunk:
                 yield chunk
-        except RuntimeError as e:
-            if "API key" in str(e):
-                yield f"ERROR: {str(e)}"
-            else:
-                yield f"ERROR: {str(e)}"
-        except Exception as e:
+            if sse:
+                yield _sse({"type": "done"})
+    except RuntimeError as e:
+        status = "errors"
+        if sse:
+            yield _sse({"type": "error", "message": str(e)})
+        else:
+            yield f"ERROR: {str(e)}"
+        chunk = await finish()
+        if chunk:
+            yield chunk
+    except Exception as e:
+        status = "errors"
+        if sse:
+            yield _sse({"type": "error", "message": f"Upstream error: {str(e)}"})
+        else:
             yield f"ERROR: Upstream error: {str(e)}"
+        chunk = await finish()
+        if chunk:
+            yield chunk
+    finally:
+        # 上流ストリームを即座に閉じて接続を解放する（応答タスクのキャンセル中でも確実に閉じる）
+        with anyio.CancelScope(shield=True):
+            await events.aclose()
+        await finish()
+        _record_stream_end(status, emitted, max_tokens)
+
+def _wants_sse(request: Request, stream_format: Optional[str]) -> bool:
+    return stream_format == "sse" or "text/event-stream" in request.headers.get("accept", "")
+
+async def _streaming_response(
+    request: Request,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+    sse: bool,
+    on_finish: Optional[OnFinish] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> StreamingResponse:
+    timings: Dict[str, float] = {}
+    started_at = time.monotonic()
+    upstream = stream_events(
+        fit_context(messages),
+        temperature,
+        max_tokens,
+        include_usage=sse,
+        timings=timings,
+    )
+    try:
+        events = await _prefetch(upstream)
+    except UpstreamBusyError as e:
+        raise _busy(e)
+    body = _stream_body(request, events, max_tokens, sse, on_finish)
+
+    headers = dict(headers or {})
+    if "queue_ms" in timings:
+        # 最初のイベントまでの時間から待ち行列の分を除いたものを上流の TTFT とする
+        ttft_ms = (time.monotonic() - started_at) * 1000 - timings["queue_ms"]
+        headers["Server-Timing"] = _server_timing({"queue_ms": timings["queue_ms"], "ttft_ms": ttft_ms})
+
+    if sse:
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        return StreamingResponse(body, media_type="text/event-stream; charset=utf-8", headers=headers)
+    return StreamingResponse(body, media_type="text/plain; charset=utf-8", headers=headers)
+
+@router.post("/chat/stream")
+async def chat_stream(
+    req: ChatRequest,
+    request: Request,
+    stream_format: Optional[str] = Query(None, alias="format"),
+):
+    """
+    既定は text/plain のチャンク
+    Accept: text/event-stream または ?format=sse で型付きイベント (delta / reasoning / usage / error / done) の SSE
+    """
+    return await _streaming_response(
+        request,
+        [m.model_dump() for m in req.messages],
+        req.temperature,
+        req.max_tokens,
+        _wants_sse(request, stream_format),
+    )
+
+@router.post("/chat/continue")
+async def chat_continue(
+    req: ContinueRequest,
+    request: Request,
+    stream_format: Optional[str] = Query(None, alias="format"),
+    x_ms_client_principal_name: Optional[str] = Header(None),
+):
+    """
+    保存済みの会話の続きを生成する（履歴はサーバー側の会話ツリーから組み立てる）
+    生成が終わったらユーザー / アシスタントの 2 ノードを 1 トランザクションで会話に追加する
+    X-User-Node-Id / X-Assistant-Node-Id ヘッダは仮のノードID。同時の保存と重なった場合は保存時に払い出し直すので、
+    SSE では done の前の saved イベント（user_node_id / assistant_node_id）が確定したID。保存に失敗したら error イベントを送る
+    """
+    user_id = get_user_id_from_header(x_ms_client_principal_name)
+    # root から親ノードまでのノードだけを読み込む
+    conversation = await run_db(
+        get_conversation,
+        req.conversation_id,
+        user_id,
+        view="path",
+        node_id=req.parent_node_id,
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    conversation_tree = conversation["conversation_tree"]
+    path = get_conversation_path(conversation_tree, req.parent_node_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Parent node not found")
+
+    user_message = {"role": "user", "content": req.message}
+    messages = path_messages(conversation_tree, path) + [user_message]
+    node_ids = await run_db(allocate_node_ids, req.conversation_id, 2)
+
+    async def save_turn(status: str, content: str) -> None:
+        # 途中で切断された場合も、生成済みの分は保存しておく
+        if not content:
+            return None
+        saved_ids = await run_db(
+            append_conversation_messages,
+            req.conversation_id,
+            user_id,
+            path[-1],
+            [user_message, {"role": "assistant", "content": content}],
+            node_ids,
+        )
+        if saved_ids is None:
+            print(f"[CHAT] Failed to append turn to conversation {req.conversation_id}")
+            return {"type": "error", "message": "Failed to save the conversation turn"}
+        return {"type": "saved", "user_node_id": saved_ids[0], "assistant_node_id": saved_ids[1]}
+
+    return await _streaming_response(
+        request,
+        messages,
+        req.temperature,
+        req.max_tokens,
+        _wants_sse(request, stream_format),
+        on_finish=save_turn,
+        headers={
+            "X-User-Node-Id": str(node_ids[0]),
+            "X-Assistant-Node-Id": str(node_ids[1]),
+        },
+    )
+
+@router.post("/chat/speech")
+async def chat_speech(req: SpeechRequest, request: Request):
+    """
+    チャットの応答を音声 (WAV ストリーム) で返す
+    LLM の生成中から文ごとに VOICEVOX で合成し始めるので、応答の生成を待たずに再生が始まる
+    """
+    upstream = stream_events(fit_context([m.model_dump() for m in req.messages]), req.temperature, req.max_tokens)
+    try:
+        events = await _prefetch(upstream)
+    except UpstreamBusyError as e:
+        raise _busy(e)
+
+    async def deltas() -> AsyncGenerator[str, None]:
+        try:
+            async for event in events:
+                if event["type"] == "delta":
+                    yield event["content"]
+        finally:
+            await events.aclose()
+
+    return await audio_stream_response(request, sentence_audio(iter_sentences(deltas()), req.speaker))
 
-    return StreamingResponse(gen(), media_type="text/plain; charset=utf-8")
+@router.get("/chat/stats")
+async def chat_stats():
+    """チャットのストリーミング / 応答キャッシュ / 同時実行制限 / リトライの統計を取得"""
+    return {
+        "stream": stream_stats,
+        "cache": response_cache.snapshot(),
+        "limiter": upstream_limiter.snapshot(),
+        "upstream": upstream_stats(),
+    }
@@ -1,21 +1,49 @@
 # app/routers/conversations.py
-from fastapi import APIRouter, HTTPException, Header
+import os
+import json
+import base64
+import hashlib
+from fastapi import APIRouter, HTTPException, Header, Query, Request, Response
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal, Tuple
+from app.jsonutil import FastJSONResponse, loads
 from app.database import (
+    run_db,
+    patch_conversation,
     save_conversation,
     get_conversation,
+    get_conversation_version,
+    get_list_version,
     list_conversations,
+    search_conversations,
+    search_available,
     delete_conversation
 )
 
 router = APIRouter(prefix="/api/conversations", tags=["conversations"])
 
+# 会話一覧の 1 ページの件数（既定値と上限）
+CONVERSATIONS_PAGE_SIZE = int(os.getenv("CONVERSATIONS_PAGE_SIZE", "50"))
+CONVERSATIONS_MAX_PAGE_SIZE = int(os.getenv("CONVERSATIONS_MAX_PAGE_SIZE", "200"))
+
+# 検索結果の件数（既定値と上限）
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "20"))
+SEARCH_RESULTS_MAX_LIMIT = int(os.getenv("SEARCH_RESULTS_MAX_LIMIT", "100"))
+
+# 会話の取得と一覧はブラウザにキャッシュさせつつ毎回 ETag で再検証させる
+CONVERSATIONS_CACHE_CONTROL = "private, no-cache"
+
 class SaveConversationRequest(BaseModel):
     conversation_id: str
     conversation_tree: Dict[str, Any]
     title: Optional[str] = None
 
+class PatchConversationRequest(BaseModel):
+    """差分保存: 追加 / 変更したノードだけを送る（キーはノードID）"""
+    nodes: Dict[str, Dict[str, Any]] = {}
+    current_path: Optional[List[Any]] = None
+    title: Optional[str] = None
+
 class ConversationResponse(BaseModel):
     id: str
     title: str
@@ -23,6 +51,13 @@ class ConversationResponse(BaseModel):
     updated_at: str
     conversation_tree: Optional[Dict[str, Any]] = None
 
+class SearchResult(BaseModel):
+    conversation_id: str
+    title: Optional[str] = None
+    updated_at: str
+    node_id: Optional[str] = None  # タイトルだけに一致した場合は None
+    snippet: str  # HTML エスケープ済み。一致部分は <mark> で囲む
+
 def get_user_id_from_header(x_ms_client_principal_name: Optional[str] = Header(None)) -> str:
     """
     Azure Static Web Appsから送られてくるヘッダーからユーザーIDを取得
@@ -34,15 +69,89 @@ def get_user_id_from_header(x_ms_client_principal_name: Optional[str] = Header(N
     # 開発環境用のダミーユーザー
     return "dev-user"
 
-@router.post("/save")
+def make_etag(*parts: Any) -> str:
+    """バージョン情報から強い ETag を作る"""
+    raw = json.dumps(parts, ensure_ascii=False, default=str).encode("utf-8")
+    return '"' + hashlib.sha256(raw).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match の判定（弱い比較。圧縮時に付く W/ は無視する）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CONVERSATIONS_CACHE_CONTROL})
+
+def encode_cursor(updated_at: str, conversation_id: str) -> str:
+    """(updated_at, id) -> 不透明なカーソル文字列"""
+    raw = json.dumps([updated_at, conversation_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, conversation_id = json.loads(raw)
+        return str(updated_at), str(conversation_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_save_request(raw: bytes) -> SaveConversationRequest:
+    """
+    /save のリクエストボディを読む
+    大きな conversation_tree を pydantic に走査させないよう、最上位の項目の型だけを確認して
+    検証なしで SaveConversationRequest を組み立てる
+    """
+    try:
+        body = loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Request body is not valid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object")
+
+    conversation_id = body.get("conversation_id")
+    conversation_tree = body.get("conversation_tree")
+    title = body.get("title")
+    if not isinstance(conversation_id, str):
+        raise HTTPException(status_code=422, detail="conversation_id must be a string")
+    if not isinstance(conversation_tree, dict):
+        raise HTTPException(status_code=422, detail="conversation_tree must be an object")
+    if title is not None and not isinstance(title, str):
+        raise HTTPException(status_code=422, detail="title must be a string")
+
+    return SaveConversationRequest.model_construct(
+        conversation_id=conversation_id,
+        conversation_tree=conversation_tree,
+        title=title,
+    )
+
+@router.post(
+    "/save",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": SaveConversationRequest.model_json_schema()}},
+        }
+    },
+)
 async def save_conversation_endpoint(
-    request: SaveConversationRequest,
+    http_request: Request,
     x_ms_client_principal_name: Optional[str] = Header(None)
 ):
-    """会話を保存"""
+    """会話を保存（ボディの形式は SaveConversationRequest）"""
     user_id = get_user_id_from_header(x_ms_client_principal_name)
+    request = parse_save_request(await http_request.body())
 
-    success = save_conversation(
+    success = await run_db(
+        save_conversation,
         conversation_id=request.conversation_id,
         user_id=user_id,
         conversation_tree=request.conversation_tree,
@@ -54,13 +163,60 @@ async def save_conversation_endpoint(
 
     return {"success": True, "conversation_id": request.conversation_id}
 
+@router.patch("/{conversation_id}")
+async def patch_conversation_endpoint(
+    conversation_id: str,
+    request: PatchConversationRequest,
+    x_ms_client_principal_name: Optional[str] = Header(None)
+):
+    """会話を差分保存（変更されたノードと currentPath だけを更新）"""
+    user_id = get_user_id_from_header(x_ms_client_principal_name)
+
+    success = await run_db(
+        patch_conversation,
+        conversation_id=conversation_id,
+        user_id=user_id,
+        nodes=request.nodes,
+        current_path=request.current_path,
+        title=request.title
+    )
+
+    if not success:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    return {"success": True, "conversation_id": conversation_id}
+
 @router.get("/list")
 async def list_conversations_endpoint(
+    response: Response,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    if_none_match: Optional[str] = Header(None),
     x_ms_client_principal_name: Optional[str] = Header(None)
 ) -> List[ConversationResponse]:
-    """ユーザーの会話一覧を取得"""
+    """
+    ユーザーの会話一覧を取得（更新日時の新しい順）
+    続きがある場合は X-Next-Cursor ヘッダのカーソルを ?after= に渡すと次のページを返す
+    ETag を If-None-Match で送ると、一覧が変わっていなければ 304 を返す（一覧は読まない）
+    """
     user_id = get_user_id_from_header(x_ms_client_principal_name)
-    conversations = list_conversations(user_id)
+    page_size = min(limit or CONVERSATIONS_PAGE_SIZE, CONVERSATIONS_MAX_PAGE_SIZE)
+    cursor = decode_cursor(after) if after else None
+
+    list_version = await run_db(get_list_version, user_id)
+    if list_version is not None:
+        etag = make_etag("list", user_id, list_version, cursor, page_size)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = CONVERSATIONS_CACHE_CONTROL
+
+    # 1 件多く取って次のページがあるかを判定する
+    conversations = await run_db(list_conversations, user_id, page_size + 1, cursor)
+    if len(conversations) > page_size:
+        conversations = conversations[:page_size]
+        last = conversations[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last["updated_at"], last["id"])
 
     return [
         ConversationResponse(
@@ -72,24 +228,71 @@ async def list_conversations_endpoint(
         for conv in conversations
     ]
 
+# /{conversation_id} より前に定義する（"search" が会話IDとして扱われないように）
+@router.get("/search")
+async def search_conversations_endpoint(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: Optional[int] = Query(None, ge=1),
+    x_ms_client_principal_name: Optional[str] = Header(None)
+) -> List[SearchResult]:
+    """
+    会話をタイトルとメッセージ本文から全文検索（関連度順、1 会話につき最も一致したもの 1 件）
+    スペース区切りの複数語は AND。node_id のノードを view=path&node_id=... で開ける
+    """
+    if not search_available():
+        raise HTTPException(status_code=503, detail="Full-text search is not available")
+
+    user_id = get_user_id_from_header(x_ms_client_principal_name)
+    size = min(limit or SEARCH_RESULTS_LIMIT, SEARCH_RESULTS_MAX_LIMIT)
+    results = await run_db(search_conversations, user_id, q, size)
+    return [SearchResult(**result) for result in results]
+
 @router.get("/{conversation_id}")
 async def get_conversation_endpoint(
     conversation_id: str,
+    view: Literal["full", "path", "subtree"] = "full",
+    node_id: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
     x_ms_client_principal_name: Optional[str] = Header(None)
 ) -> ConversationResponse:
-    """会話を取得"""
+    """
+    会話を取得
+    view=path: currentPath 上のノードだけ（node_id を指定すると root から node_id まで）
+    view=subtree&node_id=...: node_id 以下の部分木だけ
+    ノードを絞った結果をそのまま /save で全体保存すると他の枝が消えるので、差分保存 (PATCH) と組み合わせること
+    ETag を If-None-Match で送ると、会話が変わっていなければツリーを読まずに 304 を返す
+    """
+    if view == "subtree" and node_id is None:
+        raise HTTPException(status_code=400, detail="node_id is required for view=subtree")
+
     user_id = get_user_id_from_header(x_ms_client_principal_name)
-    conversation = get_conversation(conversation_id, user_id)
+
+    if if_none_match:
+        current = await run_db(get_conversation_version, conversation_id, user_id)
+        if current is not None:
+            etag = make_etag(conversation_id, user_id, *current, view, node_id)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+
+    conversation = await run_db(get_conversation, conversation_id, user_id, view, node_id)
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    return ConversationResponse(
-        id=conversation["id"],
-        title=conversation["title"],
-        created_at=conversation["created_at"],
-        updated_at=conversation["updated_at"],
-        conversation_tree=conversation["conversation_tree"]
+    etag = make_etag(
+        conversation_id, user_id, conversation["created_at"], conversation["version"], view, node_id
+    )
+
+    # ツリーは DB から読んだ dict をそのまま書き出す（ConversationResponse での再検証を通さない）
+    return FastJSONResponse(
+        {
+            "id": conversation["id"],
+            "title": conversation["title"],
+            "created_at": conversation["created_at"],
+            "updated_at": conversation["updated_at"],
+            "conversation_tree": conversation["conversation_tree"],
+        },
+        headers={"ETag": etag, "Cache-Control": CONVERSATIONS_CACHE_CONTROL},
     )
 
 @router.delete("/{conversation_id}")
@@ -99,7 +302,7 @@ async def delete_conversation_endpoint(
 ):
     """会話を削除"""
     user_id = get_user_id_from_header(x_ms_client_principal_name)
-    success = delete_conversation(conversation_id, user_id)
+    success = await run_db(delete_conversation, conversation_id, user_id)
 
     if not success:
         raise HTTPException(status_code=404, detail="Conversation not found")
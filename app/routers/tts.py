@@ -1,95 +1,220 @@
 # app/routers/tts.py
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import Response
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-import httpx
-import os
+from typing import AsyncGenerator, AsyncIterator, Literal, Optional, Tuple
+import anyio
+from app.services.audio_encode import AUDIO_FORMATS, available_formats, encode_snapshot
+from app.services.tts_cache import tts_cache
+from app.services.tts_stream import split_sentences, stream_sentence_audio
+from app.services.voicevox import cached_audio, speakers_cache, voicevox_snapshot
 
 router = APIRouter(prefix="/api/tts", tags=["tts"])
 
-# VOICEVOX Web API エンドポイント
-VOICEVOX_API_BASE = os.getenv("VOICEVOX_API_BASE", "https://deprecatedapis.tts.quest/v2/voicevox")
+AudioFormat = Literal["wav", "opus", "mp3"]
 
 class TTSRequest(BaseModel):
     text: str
     speaker: int = 1  # 1: ずんだもん（ノーマル）
+    format: Optional[AudioFormat] = None  # 省略時は Accept から選ぶ（既定は wav）
 
-@router.post("/voicevox")
-async def generate_voicevox_audio(request: TTSRequest):
+# Accept の MIME タイプ -> 形式
+_ACCEPT_FORMATS = {
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+}
+
+def choose_format(requested: Optional[str], accept: Optional[str]) -> str:
     """
-    VOICEVOX Web APIを使って音声を生成
-    speaker: 1 = ずんだもん（ノーマル）
+    返す音声の形式を決める
+    format 指定があればそれ（ffmpeg がない環境では wav にフォールバック）、なければ Accept の q 値で選ぶ
+    Accept が */* だけなら従来どおり wav
     """
-    try:
-        # テキストが空の場合はエラー
-        if not request.text.strip():
-            raise HTTPException(status_code=400, detail="Text is required")
-
-        # VOICEVOX APIに音声クエリを送信
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # 音声クエリを作成
-            query_response = await client.post(
-                f"{VOICEVOX_API_BASE}/audio_query",
-                params={"text": request.text, "speaker": request.speaker}
-            )
+    available = available_formats()
+    if requested:
+        if requested not in available:
+            print(f"[TTS] Format {requested} is not available, falling back to wav")
+            return "wav"
+        return requested
 
-            if query_response.status_code != 200:
-                print(f"[TTS] Audio query failed: {query_response.status_code}")
-                raise HTTPException(
-                    status_code=query_response.status_code,
-                    detail="Failed to create audio query"
-                )
+    best, best_q = "wav", 0.0
+    for item in (accept or "").split(","):
+        media_type, _, params = item.strip().partition(";")
+        audio_format = _ACCEPT_FORMATS.get(media_type.strip().lower())
+        if audio_format not in available:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if q > best_q:
+            best, best_q = audio_format, q
+    return best
 
-            audio_query = query_response.json()
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Range ヘッダ（単一範囲の bytes=start-end / start- / -suffix）を [start, end] にする
+    解釈できない・複数範囲の場合は None（全体を返す）。範囲外なら ValueError
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        elif last:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
 
-            # 音声合成
-            synthesis_response = await client.post(
-                f"{VOICEVOX_API_BASE}/synthesis",
-                params={"speaker": request.speaker},
-                json=audio_query
-            )
+def _audio_response(request: Request, data: bytes, key: str, cache_status: str, media_type: str = "audio/wav") -> Response:
+    """
+    音声を返す（キャッシュキー由来の強い ETag、If-None-Match で 304、Range で 206）
+    """
+    etag = f'"{key[:32]}"'
+    headers = {
+        "Cache-Control": "public, max-age=3600",
+        "Content-Disposition": "inline",
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "X-Cache": cache_status,
+        "Vary": "Accept",
+    }
 
-            if synthesis_response.status_code != 200:
-                print(f"[TTS] Synthesis failed: {synthesis_response.status_code}")
-                raise HTTPException(
-                    status_code=synthesis_response.status_code,
-                    detail="Failed to synthesize audio"
-                )
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
 
-            # 音声データを返す
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = _parse_range(range_header, len(data))
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        if byte_range is not None:
+            start, end = byte_range
             return Response(
-                content=synthesis_response.content,
-                media_type="audio/wav",
-                headers={
-                    "Cache-Control": "public, max-age=3600",
-                    "Content-Disposition": "inline"
-                }
+                content=data[start:end + 1],
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{len(data)}"},
             )
 
-    except httpx.TimeoutException:
-        print("[TTS] Request timeout")
-        raise HTTPException(status_code=504, detail="VOICEVOX API timeout")
-    except Exception as e:
-        print(f"[TTS] Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return Response(content=data, media_type=media_type, headers=headers)
 
-@router.get("/speakers")
-async def get_voicevox_speakers():
+def sentence_audio(sentences: AsyncIterator[str], speaker: int) -> AsyncGenerator[bytes, None]:
+    """文のストリーム -> 1 本の WAV ストリーム（文ごとの音声はキャッシュも使う）"""
+    async def synthesize(sentence: str) -> bytes:
+        data, _, _ = await cached_audio(sentence, speaker)
+        return data
+
+    return stream_sentence_audio(sentences, synthesize)
+
+async def audio_stream_response(request: Request, audio: AsyncGenerator[bytes, None]) -> StreamingResponse:
     """
-    利用可能なVOICEVOX話者一覧を取得
+    WAV ストリームを返す
+    最初の文の合成まではヘッダを送らずに待つので、そこまでのエラーは通常の HTTP エラーになる
     """
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{VOICEVOX_API_BASE}/speakers")
+        first = await audio.__anext__()
+    except StopAsyncIteration:
+        raise HTTPException(status_code=400, detail="Text is required")
+    except HTTPException:
+        raise
+    except Exception as e:
+        # テキストの上流（LLM など）のエラー
+        print(f"[TTS] Stream error: {e}")
+        raise HTTPException(status_code=502, detail=f"Upstream error: {str(e)}")
 
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail="Failed to fetch speakers"
-                )
+    async def body() -> AsyncGenerator[bytes, None]:
+        try:
+            yield first
+            async for chunk in audio:
+                # クライアントが切断していたら残りの合成を止める
+                if await request.is_disconnected():
+                    break
+                yield chunk
+        except Exception as e:
+            # ヘッダ送信後のエラーはストリームを打ち切るだけ
+            print(f"[TTS] Stream error: {e}")
+        finally:
+            with anyio.CancelScope(shield=True):
+                await audio.aclose()
 
-            return response.json()
+    return StreamingResponse(
+        body(),
+        media_type="audio/wav",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
 
-    except Exception as e:
-        print(f"[TTS] Error fetching speakers: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+@router.post("/voicevox")
+async def generate_voicevox_audio(request: TTSRequest, http_request: Request):
+    """
+    VOICEVOX Web APIを使って音声を生成
+    speaker: 1 = ずんだもん（ノーマル）
+    同じテキスト（正規化後）と話者の音声はキャッシュから返す（X-Cache: memory / disk / coalesced / miss）
+    format（または Accept: audio/ogg / audio/mpeg）で Opus (Ogg) / MP3 に変換して返す
+    """
+    audio_format = choose_format(request.format, http_request.headers.get("accept"))
+    data, key, status = await cached_audio(request.text, request.speaker, audio_format)
+    return _audio_response(http_request, data, key, status, AUDIO_FORMATS[audio_format]["media_type"])
+
+@router.get("/voicevox")
+async def get_voicevox_audio(
+    http_request: Request,
+    text: str = Query(..., min_length=1),
+    speaker: int = 1,
+    audio_format: Optional[AudioFormat] = Query(None, alias="format")
+):
+    """
+    POST /voicevox の GET 版（<audio src> から使えるように。ETag / Range に対応）
+    """
+    audio_format = choose_format(audio_format, http_request.headers.get("accept"))
+    data, key, status = await cached_audio(text, speaker, audio_format)
+    return _audio_response(http_request, data, key, status, AUDIO_FORMATS[audio_format]["media_type"])
+
+@router.post("/voicevox/stream")
+async def stream_voicevox_audio(request: TTSRequest, http_request: Request):
+    """
+    長いテキスト用: 文（。！？ や改行）ごとに並列で合成し、順番どおりに 1 本の WAV としてストリーミングする
+    最初の文の音声ができた時点で再生を始められる
+    """
+    sentences = split_sentences(request.text)
+
+    async def iter_list() -> AsyncGenerator[str, None]:
+        for sentence in sentences:
+            yield sentence
+
+    return await audio_stream_response(http_request, sentence_audio(iter_list(), request.speaker))
+
+@router.get("/stats")
+async def tts_stats():
+    """TTS キャッシュの統計（ヒット率、節約したバイト数など）、圧縮形式への変換と VOICEVOX の状態"""
+    return {**tts_cache.snapshot(), "encode": encode_snapshot(), "voicevox": voicevox_snapshot()}
+
+@router.get("/speakers")
+async def get_voicevox_speakers(response: Response):
+    """
+    利用可能なVOICEVOX話者一覧を取得
+    メモリのキャッシュから返す（X-Cache: fresh / stale / miss / degraded）
+    """
+    speakers, status = await speakers_cache.get()
+    response.headers["X-Cache"] = status
+    return speakers
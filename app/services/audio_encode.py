@@ -0,0 +1,164 @@
+# app/services/audio_encode.py
+import os
+import time
+import shutil
+import asyncio
+from typing import Any, Dict, List, Optional
+
+# 音声の圧縮形式への変換（ffmpeg のサブプロセスで行う）
+# imageio-ffmpeg は任意（requirements.txt で入る静的ビルドの ffmpeg。App Service には ffmpeg が無いため）
+try:
+    import imageio_ffmpeg
+except ImportError:
+    imageio_ffmpeg = None
+
+def _find_ffmpeg() -> Optional[str]:
+    """FFMPEG_PATH → PATH 上の ffmpeg → imageio-ffmpeg 同梱のバイナリの順に探す"""
+    path = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg")
+    if path or imageio_ffmpeg is None:
+        return path
+    try:
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except RuntimeError:
+        return None
+
+FFMPEG_PATH = _find_ffmpeg()
+# true なら ffmpeg / エンコーダーが無いときに起動を失敗させる（既定はログに警告を出して wav のみで動く）
+TTS_ENCODE_REQUIRED = os.getenv("TTS_ENCODE_REQUIRED", "false").lower() == "true"
+# 同時に動かす ffmpeg の数（CPU を使い切らないように）
+TTS_ENCODE_WORKERS = int(os.getenv("TTS_ENCODE_WORKERS", str(os.cpu_count() or 2)))
+TTS_ENCODE_TIMEOUT = float(os.getenv("TTS_ENCODE_TIMEOUT", "30"))
+TTS_OPUS_BITRATE = os.getenv("TTS_OPUS_BITRATE", "32k")
+TTS_MP3_BITRATE = os.getenv("TTS_MP3_BITRATE", "64k")
+
+# 形式 -> (Content-Type, ffmpeg の出力オプション)
+AUDIO_FORMATS: Dict[str, Dict[str, Any]] = {
+    "wav": {"media_type": "audio/wav", "args": None},
+    "opus": {
+        "media_type": "audio/ogg",
+        "args": ["-c:a", "libopus", "-b:a", TTS_OPUS_BITRATE, "-application", "voip", "-f", "ogg"],
+    },
+    "mp3": {
+        "media_type": "audio/mpeg",
+        "args": ["-c:a", "libmp3lame", "-b:a", TTS_MP3_BITRATE, "-f", "mp3"],
+    },
+}
+
+_workers: Optional[asyncio.Semaphore] = None
+# 起動時に ffmpeg のエンコーダーを確認した結果（None = 未確認）
+_checked_formats: Optional[List[str]] = None
+
+encode_stats = {
+    "encoded": 0,
+    "errors": 0,
+    "encode_ms": 0.0,
+    "input_bytes": 0,
+    "output_bytes": 0,
+}
+
+def available_formats() -> List[str]:
+    """この環境で返せる形式（ffmpeg がなければ wav のみ。起動時の確認後はエンコーダーがある形式だけ）"""
+    if _checked_formats is not None:
+        return _checked_formats
+    return list(AUDIO_FORMATS) if FFMPEG_PATH else ["wav"]
+
+async def check_encoders() -> List[str]:
+    """
+    起動時（lifespan）に ffmpeg と各形式のエンコーダーがあるかを確認する
+    無ければ警告をログに出し（TTS_ENCODE_REQUIRED なら起動を失敗させ）、その形式は返さない
+    """
+    global _checked_formats
+    formats = ["wav"]
+    missing: List[str] = []
+    encoders = ""
+    if FFMPEG_PATH:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, "-hide_banner", "-encoders",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            out, _ = await asyncio.wait_for(proc.communicate(), TTS_ENCODE_TIMEOUT)
+            encoders = out.decode(errors="replace")
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"[TTS] WARNING: ffmpeg at {FFMPEG_PATH} could not be run: {e!r}")
+    for audio_format, spec in AUDIO_FORMATS.items():
+        if spec["args"] is None:
+            continue
+        encoder = spec["args"][spec["args"].index("-c:a") + 1]
+        if f" {encoder} " in encoders:
+            formats.append(audio_format)
+        else:
+            missing.append(f"{audio_format} ({encoder})")
+
+    _checked_formats = formats
+    if missing:
+        reason = f"ffmpeg at {FFMPEG_PATH}" if FFMPEG_PATH else "ffmpeg not found (install imageio-ffmpeg or set FFMPEG_PATH)"
+        message = f"Audio formats unavailable, serving wav instead: {', '.join(missing)} - {reason}"
+        if TTS_ENCODE_REQUIRED:
+            raise RuntimeError(message)
+        print(f"[TTS] WARNING: {message}")
+    else:
+        print(f"[TTS] Audio encoders ready: {', '.join(formats)} ({FFMPEG_PATH})")
+    return formats
+
+def format_params(audio_format: str) -> Dict[str, Any]:
+    """キャッシュキーに含める変換パラメータ（ビットレートを変えたら別のキーになる）"""
+    args = AUDIO_FORMATS[audio_format]["args"]
+    return {"format": audio_format, "args": args} if args else {}
+
+def _get_workers() -> asyncio.Semaphore:
+    global _workers
+    if _workers is None:
+        _workers = asyncio.Semaphore(TTS_ENCODE_WORKERS)
+    return _workers
+
+async def encode_audio(wav: bytes, audio_format: str) -> bytes:
+    """
+    WAV を audio_format に変換する
+    ffmpeg は別プロセスで動くのでイベントループは止まらない。同時実行数は TTS_ENCODE_WORKERS まで
+    """
+    args = AUDIO_FORMATS[audio_format]["args"]
+    if args is None:
+        return wav
+    if not FFMPEG_PATH:
+        raise RuntimeError("ffmpeg is not available")
+
+    async with _get_workers():
+        started_at = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-f", "wav", "-i", "pipe:0", *args, "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(wav), TTS_ENCODE_TIMEOUT)
+        except BaseException:
+            # タイムアウト・キャンセル時は ffmpeg を残さない
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            encode_stats["errors"] += 1
+            raise
+        if proc.returncode != 0:
+            encode_stats["errors"] += 1
+            raise RuntimeError(f"ffmpeg failed ({proc.returncode}): {err.decode(errors='replace').strip()}")
+
+    encode_stats["encoded"] += 1
+    encode_stats["encode_ms"] += (time.perf_counter() - started_at) * 1000
+    encode_stats["input_bytes"] += len(wav)
+    encode_stats["output_bytes"] += len(out)
+    return out
+
+def encode_snapshot() -> Dict[str, Any]:
+    """変換の統計（平均の変換時間と、WAV に対するサイズの比率）"""
+    encoded = encode_stats["encoded"]
+    return {
+        **encode_stats,
+        "formats": available_formats(),
+        "ffmpeg": FFMPEG_PATH,
+        "avg_encode_ms": encode_stats["encode_ms"] / encoded if encoded else 0.0,
+        "size_ratio": encode_stats["output_bytes"] / encode_stats["input_bytes"] if encode_stats["input_bytes"] else 0.0,
+    }
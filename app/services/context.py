@@ -0,0 +1,183 @@
+# app/services/context.py
+import os
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from app.services.openai_service import MODEL, complete_once
+
+# 上流に送るプロンプトのトークン上限（0 で無効）
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "8000"))
+# 落とした履歴を要約で置き換えるか
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "false").lower() == "true"
+# 要約はこのメッセージ数の単位（ブロック境界）までの履歴ごとに作り、数ターン使い回す
+CONTEXT_SUMMARY_BLOCK = int(os.getenv("CONTEXT_SUMMARY_BLOCK", "8"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+CONTEXT_SUMMARY_CACHE_SIZE = int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "256"))
+
+# メッセージごとの固定オーバーヘッド（role や区切りトークン分）
+_MESSAGE_OVERHEAD = 4
+_REPLY_PRIMING = 2
+
+SUMMARY_PROMPT = (
+    "以下はユーザーとアシスタントの会話の前半です。"
+    "後続の応答に必要な事実・決定事項・ユーザーの意図を残して、日本語で簡潔に要約してください。"
+)
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken が無ければ文字数ベースの概算にする
+    tiktoken = None
+
+def _load_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            # 未知のモデル名は最近の OpenAI モデルと同じ encoding とみなす
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # BPE ファイルを取得できない環境など
+        print(f"[CONTEXT] tiktoken unavailable, using estimate: {e}")
+        return None
+
+_encoding = None
+_encoding_loaded = False
+
+def load_tokenizer() -> None:
+    """
+    tokenizer を読み込む（初回は BPE ファイルの取得が走るので、lifespan でスレッドから呼んでおく）
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding = _load_encoding()
+        _encoding_loaded = True
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """テキストのトークン数（tiktoken が無い場合は ASCII 4 文字 / 非 ASCII 1 文字 ≒ 1 トークンで概算）"""
+    load_tokenizer()
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def count_message_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(_MESSAGE_OVERHEAD + count_tokens(m.get("content") or "") for m in messages) + _REPLY_PRIMING
+
+# 要約キャッシュ（落とした履歴のハッシュ -> 要約）と生成中のタスク
+_summaries: "OrderedDict[str, str]" = OrderedDict()
+_summary_tasks: Dict[str, asyncio.Task] = {}
+
+def _history_key(messages: List[Dict[str, Any]]) -> str:
+    canonical = json.dumps(
+        [(m["role"], m.get("content") or "") for m in messages],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def _summarize(key: str, dropped: List[Dict[str, Any]]) -> None:
+    transcript = "\n".join(f"{m['role']}: {m.get('content') or ''}" for m in dropped)
+    try:
+        result = await complete_once(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0.0,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+        )
+        _summaries[key] = result["content"]
+        while len(_summaries) > CONTEXT_SUMMARY_CACHE_SIZE:
+            _summaries.popitem(last=False)
+    except Exception as e:
+        print(f"[CONTEXT] Failed to summarize history: {e}")
+    finally:
+        _summary_tasks.pop(key, None)
+
+def _cached_summary(dropped: List[Dict[str, Any]], generate: bool = True) -> Optional[str]:
+    """
+    要約がキャッシュにあれば返す。無ければ（generate なら）バックグラウンドで生成を始めて None を返す
+    （今回のリクエストは要約なしで送り、次のターン以降で使う）
+    """
+    key = _history_key(dropped)
+    summary = _summaries.get(key)
+    if summary is not None:
+        _summaries.move_to_end(key)
+        return summary
+    if generate and key not in _summary_tasks:
+        _summary_tasks[key] = asyncio.get_running_loop().create_task(_summarize(key, dropped))
+    return None
+
+def _summary_message(summary: str) -> Dict[str, str]:
+    return {"role": "system", "content": f"これまでの会話の要約:\n{summary}"}
+
+def _tail_start(history: List[Dict[str, Any]], budget: int) -> int:
+    """budget に収まるように新しいものから残したときの先頭の位置（最後のメッセージは必ず残す）"""
+    used = 0
+    cut = len(history)
+    while cut > 0:
+        cost = _MESSAGE_OVERHEAD + count_tokens(history[cut - 1].get("content") or "")
+        if used + cost > budget and cut < len(history):
+            break
+        used += cost
+        cut -= 1
+    return cut
+
+def fit_context(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    プロンプトを CONTEXT_MAX_TOKENS に収める
+    system メッセージは全て残し、それ以外は新しいものから入るだけ残す（最後のメッセージは必ず残す）
+    要約を使う場合は要約のトークン数も予算に含める
+    """
+    before = count_message_tokens(messages)
+    if CONTEXT_MAX_TOKENS <= 0 or before <= CONTEXT_MAX_TOKENS:
+        print(f"[CONTEXT] {before} tokens")
+        return messages
+
+    system = [m for m in messages if m["role"] == "system"]
+    history = [m for m in messages if m["role"] != "system"]
+
+    budget = CONTEXT_MAX_TOKENS - count_message_tokens(system)
+    cut = _tail_start(history, budget)
+
+    summary = None
+    if CONTEXT_SUMMARY_ENABLED and cut > 0:
+        # 要約はブロック境界までの履歴ごとに作り、同じ要約を数ターン使い回す
+        # 切り上げた境界の要約がまだ無ければ生成を始め、今回は 1 つ前の境界の要約（あれば）を使う
+        block = max(1, CONTEXT_SUMMARY_BLOCK)
+        boundary = min(len(history) - 1, -(-cut // block) * block)
+        summarized = 0
+        for candidate in (boundary, boundary - block):
+            if candidate <= 0:
+                break
+            summary = _cached_summary(history[:candidate], generate=candidate == boundary)
+            if summary is not None:
+                summarized = candidate
+                break
+        if summary is not None:
+            # 要約の分だけ予算を減らして残す範囲を選び直す（要約より前は要約に含まれている）
+            summary_cost = count_message_tokens([_summary_message(summary)]) - _REPLY_PRIMING
+            last_cost = _MESSAGE_OVERHEAD + count_tokens(history[-1].get("content") or "")
+            if summary_cost + last_cost <= budget:
+                cut = max(summarized, _tail_start(history, budget - summary_cost))
+            else:
+                summary = None
+
+    trimmed = list(system)
+    if summary:
+        trimmed.append(_summary_message(summary))
+    trimmed.extend(history[cut:])
+
+    after = count_message_tokens(trimmed)
+    print(
+        f"[CONTEXT] {before} -> {after} tokens "
+        f"({cut} messages dropped{', summarized' if summary else ''})"
+    )
+    return trimmed
@@ -0,0 +1,98 @@
+# app/services/limiter.py
+import os
+import math
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+# 上流 LLM への同時リクエスト数の上限と待ち行列の設定
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "16"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "64"))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv("OPENAI_QUEUE_TIMEOUT", "10"))
+
+class UpstreamBusyError(Exception):
+    """待ち行列が満杯 / 待ち時間切れで上流に送れなかった（503 + Retry-After で返す）"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ConcurrencyLimiter:
+    """
+    上流呼び出しの同時実行数を max_in_flight に制限するセマフォ + 待ち行列
+    待ち行列が max_queue を超える場合は待たずに UpstreamBusyError を投げる
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._sem = asyncio.Semaphore(max_in_flight)
+        self._waiting = 0
+        self._in_flight = 0
+        self.stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "timeouts": 0,
+            "queue_wait_ms_total": 0.0,
+            "upstream_ms_total": 0.0,
+        }
+
+    def _retry_after(self) -> int:
+        """平均の上流処理時間と待ち人数から、空きが出るまでの秒数をざっくり見積もる"""
+        completed = self.stats["admitted"] - self._in_flight
+        avg_s = self.stats["upstream_ms_total"] / completed / 1000 if completed > 0 else 1.0
+        estimate = avg_s * (self._waiting + 1) / self.max_in_flight
+        return min(60, max(1, math.ceil(estimate)))
+
+    @asynccontextmanager
+    async def slot(self, timings: Optional[Dict[str, float]] = None) -> AsyncIterator[None]:
+        """
+        空き枠を 1 つ確保して上流呼び出しを実行する
+        timings を渡すと queue_ms（待ち時間）と upstream_ms（枠を保持していた時間）を書き込む
+        """
+        # 実行中 + 待機中が上限に達していたら待たずに断る
+        if self._in_flight + self._waiting >= self.max_in_flight + self.max_queue:
+            self.stats["rejected"] += 1
+            raise UpstreamBusyError("Upstream queue is full", self._retry_after())
+
+        queued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise UpstreamBusyError("Timed out waiting for an upstream slot", self._retry_after())
+        finally:
+            self._waiting -= 1
+
+        started_at = time.monotonic()
+        queue_ms = (started_at - queued_at) * 1000
+        self.stats["admitted"] += 1
+        self.stats["queue_wait_ms_total"] += queue_ms
+        if timings is not None:
+            timings["queue_ms"] = queue_ms
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._sem.release()
+            upstream_ms = (time.monotonic() - started_at) * 1000
+            self.stats["upstream_ms_total"] += upstream_ms
+            if timings is not None:
+                timings["upstream_ms"] = upstream_ms
+
+    def snapshot(self) -> Dict[str, float]:
+        admitted = self.stats["admitted"]
+        return {
+            **self.stats,
+            "in_flight": self._in_flight,
+            "queued": self._waiting,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "avg_queue_wait_ms": self.stats["queue_wait_ms_total"] / admitted if admitted else 0.0,
+        }
+
+upstream_limiter = ConcurrencyLimiter(OPENAI_MAX_IN_FLIGHT, OPENAI_MAX_QUEUE, OPENAI_QUEUE_TIMEOUT)
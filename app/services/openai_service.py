@@ -1,12 +1,75 @@
 # app/services/openai_service.py
 import os
 import json
+import time
 import httpx
-from typing import AsyncGenerator, List, Dict, Any
+from typing import AsyncGenerator, List, Dict, Any, Optional
+from app.services.limiter import upstream_limiter
+from app.services.retry import (
+    OPENAI_REQUEST_DEADLINE,
+    latency_tracker,
+    send_hedged,
+    send_with_retry,
+)
 
 OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
 MODEL = os.getenv("MODEL", "gpt-4o-mini")
 
+# 上流 HTTP クライアント設定（プロセス内で 1 つを共有し、接続を再利用する）
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))
+OPENAI_WRITE_TIMEOUT = float(os.getenv("OPENAI_WRITE_TIMEOUT", "30"))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "30"))
+
+_client: httpx.AsyncClient | None = None
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _build_client() -> httpx.AsyncClient:
+    http2 = OPENAI_HTTP2 and _http2_available()
+    if OPENAI_HTTP2 and not http2:
+        print("[OPENAI] h2 is not installed - falling back to HTTP/1.1")
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=OPENAI_CONNECT_TIMEOUT,
+            read=OPENAI_READ_TIMEOUT,
+            write=OPENAI_WRITE_TIMEOUT,
+            pool=OPENAI_POOL_TIMEOUT,
+        ),
+    )
+
+def get_client() -> httpx.AsyncClient:
+    """
+    プロセス共有の AsyncClient を返す（未作成・クローズ済みなら作り直す）
+    通常は app の lifespan 開始時に作成される
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+async def close_client() -> None:
+    """lifespan 終了時に共有クライアントを閉じる"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 def _auth_headers() -> Dict[str, str]:
     key = os.getenv("OPENAI_API_KEY")
     if not key:
@@ -20,9 +83,11 @@ async def complete_once(
     messages: List[Dict[str, Any]],
     temperature: float = 0.3,
     max_tokens: int = 512,
+    timings: Optional[Dict[str, float]] = None,
 ) -> Dict[str, Any]:
     """
     Returns dict with 'content' and optionally 'reasoning' (for o1 models)
+    timings を渡すと待ち行列の待ち時間 (queue_ms) と上流の所要時間 (upstream_ms) を書き込む
     """
     url = f"{OPENAI_API_BASE.rstrip('/')}/chat/completions"
     payload = {
@@ -32,34 +97,43 @@ async def complete_once(
         "max_tokens": max_tokens,
         "stream": False,
     }
-    async with httpx.AsyncClient(timeout=None) as client:
-        r = await client.post(url, headers=_auth_headers(), json=payload)
+    headers = _auth_headers()
+    client = get_client()
+    deadline = time.monotonic() + OPENAI_REQUEST_DEADLINE
+    async with upstream_limiter.slot(timings):
+        started_at = time.monotonic()
+        r = await send_hedged(lambda: client.post(url, headers=headers, json=payload), deadline)
         r.raise_for_status()
+        latency_tracker.record(time.monotonic() - started_at)
         j = r.json()
-        choice = j["choices"][0]
-        message = choice["message"]
+    choice = j["choices"][0]
+    message = choice["message"]
 
-        result = {"content": message["content"]}
+    result = {"content": message["content"]}
 
-        # o1 models return reasoning_content
-        if "reasoning_content" in message and message["reasoning_content"]:
-            result["reasoning"] = message["reasoning_content"]
+    # o1 models return reasoning_content
+    if "reasoning_content" in message and message["reasoning_content"]:
+        result["reasoning"] = message["reasoning_content"]
 
-        # Extract thinking time from usage if available
-        if "usage" in j and "completion_tokens_details" in j["usage"]:
-            details = j["usage"]["completion_tokens_details"]
-            if "reasoning_tokens" in details:
-                result["reasoning_tokens"] = details["reasoning_tokens"]
+    # Extract thinking time from usage if available
+    if "usage" in j and "completion_tokens_details" in j["usage"]:
+        details = j["usage"]["completion_tokens_details"]
+        if "reasoning_tokens" in details:
+            result["reasoning_tokens"] = details["reasoning_tokens"]
 
-        return result
+    return result
 
-async def stream_completion(
+async def stream_events(
     messages: List[Dict[str, Any]],
     temperature: float = 0.3,
     max_tokens: int = 512,
-) -> AsyncGenerator[str, None]:
+    include_usage: bool = False,
+    timings: Optional[Dict[str, float]] = None,
+) -> AsyncGenerator[Dict[str, Any], None]:
     """
-    OpenAI SSEの 'data: {...}' 行から delta.content を逐次 yield
+    OpenAI SSEの 'data: {...}' 行を型付きイベントに変換して逐次 yield
+    {"type": "delta" | "reasoning", "content": str} / {"type": "usage", "usage": {...}}
+    同時実行枠はストリームが終わるまで保持する
     """
     url = f"{OPENAI_API_BASE.rstrip('/')}/chat/completions"
     payload = {
@@ -69,8 +143,16 @@ async def stream_completion(
         "max_tokens": max_tokens,
         "stream": True,
     }
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers=_auth_headers(), json=payload) as r:
+    if include_usage:
+        # 最後のチャンクで usage を返してもらう
+        payload["stream_options"] = {"include_usage": True}
+    headers = _auth_headers()
+    client = get_client()
+    deadline = time.monotonic() + OPENAI_REQUEST_DEADLINE
+    async with upstream_limiter.slot(timings):
+        request = client.build_request("POST", url, headers=headers, json=payload)
+        r = await send_with_retry(lambda: client.send(request, stream=True), deadline)
+        try:
             r.raise_for_status()
             async for line in r.aiter_lines():
                 if not line or not line.startswith("data:"):
@@ -80,9 +162,40 @@ async def stream_completion(
                     break
                 try:
                     obj = json.loads(data)
-                    delta = obj["choices"][0]["delta"].get("content")
-                    if delta:
-                        yield delta
-                except Exception:
-                    # roleのみ/parse失敗はスキップ
+                except ValueError:
+                    # parse失敗はスキップ
                     continue
+
+                usage = obj.get("usage")
+                if usage:
+                    yield {"type": "usage", "usage": usage}
+
+                choices = obj.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta") or {}
+                # o1 系などは reasoning_content を返す（roleのみのチャンクは何も出さない）
+                reasoning = delta.get("reasoning_content")
+                if reasoning:
+                    yield {"type": "reasoning", "content": reasoning}
+                content = delta.get("content")
+                if content:
+                    yield {"type": "delta", "content": content}
+        finally:
+            await r.aclose()
+
+async def stream_completion(
+    messages: List[Dict[str, Any]],
+    temperature: float = 0.3,
+    max_tokens: int = 512,
+) -> AsyncGenerator[str, None]:
+    """
+    OpenAI SSEの 'data: {...}' 行から delta.content を逐次 yield
+    """
+    events = stream_events(messages, temperature, max_tokens)
+    try:
+        async for event in events:
+            if event["type"] == "delta":
+                yield event["content"]
+    finally:
+        await events.aclose()
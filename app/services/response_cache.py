@@ -0,0 +1,135 @@
+# app/services/response_cache.py
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# /api/chat の応答キャッシュ設定
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024"))
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "600"))
+# これ以下の temperature のリクエストだけをキャッシュ対象にする
+# 既定は 0（temperature=0 の決定的なリクエストだけ）。ChatRequest の既定 0.3 のようなサンプリングありの
+# 応答までキャッシュすると同じ質問に毎回同じ答えが返るので、0 より大きい値は明示的に設定したときだけ
+CHAT_CACHE_MAX_TEMPERATURE = float(os.getenv("CHAT_CACHE_MAX_TEMPERATURE", "0"))
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+) -> str:
+    """(model, messages, temperature, max_tokens) の正規化 JSON の SHA-256"""
+    canonical = json.dumps(
+        {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    LRU + TTL + バイト上限つきの応答キャッシュ
+    同じキーの処理中リクエストは 1 つの上流呼び出しにまとめる（request coalescing）
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (expires_at, size, value)
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._bytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "bypassed": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        # 古いものから追い出す
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Dict[str, Any]]],
+    ) -> Tuple[Dict[str, Any], str]:
+        """
+        キャッシュ済みならそれを返し、未キャッシュなら compute() を 1 回だけ実行する
+        戻り値は (結果, "hit" | "coalesced" | "miss")
+        """
+        value = self.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value, "hit"
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            # 先行リクエストがキャンセルされても共有タスクは止めない
+            return await asyncio.shield(task), "coalesced"
+
+        self.stats["misses"] += 1
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = task
+
+        def _done(t: asyncio.Future) -> None:
+            self._inflight.pop(key, None)
+            if not t.cancelled() and t.exception() is None:
+                self.put(key, t.result())
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), "miss"
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "inflight": len(self._inflight),
+            "hit_ratio": (self.stats["hits"] + self.stats["coalesced"]) / lookups if lookups else 0.0,
+        }
+
+response_cache = ResponseCache(CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_MAX_BYTES, CHAT_CACHE_TTL)
@@ -0,0 +1,160 @@
+# app/services/retry.py
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+import httpx
+
+# 上流呼び出しのリトライ設定
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+# 1 回の呼び出し全体（リトライ込み）の締め切り秒数
+OPENAI_REQUEST_DEADLINE = float(os.getenv("OPENAI_REQUEST_DEADLINE", "120"))
+
+# ヘッジ（遅い非ストリーミング呼び出しに対して重複リクエストを送る）設定
+OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "1.0"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+# 全呼び出しのうちヘッジしてよい割合の上限（トークン消費の増加を抑える）
+OPENAI_HEDGE_MAX_RATIO = float(os.getenv("OPENAI_HEDGE_MAX_RATIO", "0.1"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+retry_stats = {
+    "calls": 0,
+    "retries": 0,
+    "gave_up": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+}
+
+Send = Callable[[], Awaitable[httpx.Response]]
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Retry-After ヘッダ（秒数 or HTTP-date）を秒に変換"""
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff(attempt: int) -> float:
+    """full jitter の指数バックオフ"""
+    return random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** attempt)))
+
+async def send_with_retry(send: Send, deadline: float) -> httpx.Response:
+    """
+    send() を締め切り (time.monotonic() 基準) まで、一時的な失敗に対してリトライする
+    リトライ対象は接続系のエラーと 429 / 5xx。待ち時間が締め切りを越える場合はリトライしない
+    ストリーミングの場合はヘッダ受信までが対象（本文の途中で切れたものはリトライしない）
+    """
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.TimeoutException("Upstream request deadline exceeded")
+
+        try:
+            response = await asyncio.wait_for(send(), timeout=remaining)
+        except asyncio.TimeoutError:
+            raise httpx.TimeoutException("Upstream request deadline exceeded")
+        except httpx.TransportError:
+            if attempt >= OPENAI_MAX_RETRIES:
+                retry_stats["gave_up"] += 1
+                raise
+            delay = _backoff(attempt)
+        else:
+            if response.status_code not in RETRYABLE_STATUS:
+                return response
+            if attempt >= OPENAI_MAX_RETRIES:
+                retry_stats["gave_up"] += 1
+                return response
+            retry_after = _retry_after_seconds(response)
+            delay = retry_after if retry_after is not None else _backoff(attempt)
+            await response.aclose()
+
+        if time.monotonic() + delay >= deadline:
+            # 待っている間に締め切りを過ぎるなら諦める
+            retry_stats["gave_up"] += 1
+            raise httpx.TimeoutException("Upstream request deadline exceeded while backing off")
+
+        attempt += 1
+        retry_stats["retries"] += 1
+        print(f"[OPENAI] Retrying upstream call in {delay:.2f}s (attempt {attempt + 1})")
+        await asyncio.sleep(delay)
+
+class LatencyTracker:
+    """直近の成功した呼び出しのレイテンシからヘッジまでの待ち時間 (p95) を求める"""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+    def hedge_delay(self) -> Optional[float]:
+        if len(self._samples) < OPENAI_HEDGE_MIN_SAMPLES:
+            return None
+        return max(OPENAI_HEDGE_MIN_DELAY, self.percentile(0.95))
+
+latency_tracker = LatencyTracker()
+
+async def send_hedged(send: Send, deadline: float) -> httpx.Response:
+    """
+    非ストリーミング呼び出し用。p95 を過ぎても応答がなければ同じリクエストをもう 1 本送り、
+    先に成功した方を採用する（もう一方はキャンセル）
+    """
+    retry_stats["calls"] += 1
+    primary = asyncio.ensure_future(send_with_retry(send, deadline))
+    delay = latency_tracker.hedge_delay() if OPENAI_HEDGE_ENABLED else None
+    if delay is None or retry_stats["hedged"] >= retry_stats["calls"] * OPENAI_HEDGE_MAX_RATIO:
+        return await primary
+
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+
+        retry_stats["hedged"] += 1
+        secondary = asyncio.ensure_future(send_with_retry(send, deadline))
+        pending.add(secondary)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is secondary:
+                        retry_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def upstream_stats() -> Dict[str, Optional[float]]:
+    return {
+        **retry_stats,
+        "p50_s": latency_tracker.percentile(0.5),
+        "p95_s": latency_tracker.percentile(0.95),
+    }
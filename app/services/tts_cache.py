@@ -0,0 +1,266 @@
+# app/services/tts_cache.py
+import os
+import json
+import asyncio
+import hashlib
+import tempfile
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# TTS 音声キャッシュ設定（メモリの LRU + ワーカー間で共有するディスク）
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "true").lower() == "true"
+TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", "256"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "voicevox_tts_cache")))
+TTS_CACHE_DISK_MAX_BYTES = int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+# 上限を超えたらこの割合まで古いファイルを消す
+TTS_CACHE_DISK_PRUNE_RATIO = float(os.getenv("TTS_CACHE_DISK_PRUNE_RATIO", "0.9"))
+
+def normalize_text(text: str) -> str:
+    """キャッシュキーと合成に使うテキスト（NFKC + 連続する空白を 1 つに）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def make_tts_key(engine: str, text: str, speaker: int, **params: Any) -> str:
+    """(エンジン, 正規化済みテキスト, 話者, 合成パラメータ) の正規化 JSON の SHA-256"""
+    canonical = json.dumps(
+        {"engine": engine, "text": text, "speaker": speaker, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class TTSCache:
+    """
+    合成済み音声の 2 段キャッシュ
+    1 段目はワーカー内のメモリ LRU（件数 / バイト上限）、2 段目はディスク（gunicorn のワーカー間で共有、合計サイズ上限）
+    同じキーの合成中リクエストは 1 回の合成にまとめる（ワーカー内）。待っているリクエストが
+    すべてキャンセルされた（クライアントの切断など）合成は止める
+    """
+
+    def __init__(self, directory: Path, max_entries: int, max_bytes: int, disk_max_bytes: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 合成中のキーごとの待っているリクエスト数
+        self._waiters: Dict[str, int] = {}
+        self._bytes = 0
+        # ディスク使用量の見積もり（None = まだ数えていない）。他ワーカーの書き込みは掃除のときに数え直す
+        self._disk_bytes: Optional[int] = None
+        self._pruning = False
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "bytes_saved": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+            "disk_errors": 0,
+            "cancelled": 0,
+        }
+
+    # --- メモリ ---
+
+    def _get_memory(self, key: str) -> Optional[bytes]:
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._bytes += len(data)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, oldest = self._entries.popitem(last=False)
+            self._bytes -= len(oldest)
+            self.stats["evictions"] += 1
+
+    # --- ディスク（ブロッキング処理なのでスレッドで実行する） ---
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.directory / key[:2] / f"{key}.{suffix}"
+
+    def _read_disk(self, key: str, suffix: str) -> Optional[bytes]:
+        path = self._path(key, suffix)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            # 最終利用時刻として mtime を更新（掃除は mtime の古い順）
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _write_disk(self, key: str, suffix: str, data: bytes) -> None:
+        path = self._path(key, suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 一時ファイルに書いてから rename する（他ワーカーが書きかけのファイルを読まないように）
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _scan_disk(self) -> List[Tuple[float, int, Path]]:
+        files: List[Tuple[float, int, Path]] = []
+        if not self.directory.exists():
+            return files
+        for path in self.directory.glob("*/*"):
+            if path.name.startswith(".tmp-"):
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _prune_disk(self) -> None:
+        """合計サイズが上限を超えていたら mtime の古い順に消す"""
+        files = self._scan_disk()
+        total = sum(size for _, size, _ in files)
+        if total > self.disk_max_bytes:
+            target = self.disk_max_bytes * TTS_CACHE_DISK_PRUNE_RATIO
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+                self.stats["disk_evictions"] += 1
+        self._disk_bytes = total
+
+    async def _maybe_prune(self, added: int) -> None:
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in await asyncio.to_thread(self._scan_disk))
+        self._disk_bytes += added
+        if self._disk_bytes <= self.disk_max_bytes or self._pruning:
+            return
+        self._pruning = True
+        try:
+            await asyncio.to_thread(self._prune_disk)
+        finally:
+            self._pruning = False
+
+    # --- 公開 API ---
+
+    async def get(self, key: str, suffix: str = "wav") -> Optional[Tuple[bytes, str]]:
+        """キャッシュ済みなら (データ, "memory" | "disk")"""
+        mem_key = f"{key}.{suffix}"
+        data = self._get_memory(mem_key)
+        if data is not None:
+            self.stats["memory_hits"] += 1
+            self.stats["bytes_saved"] += len(data)
+            return data, "memory"
+        try:
+            data = await asyncio.to_thread(self._read_disk, key, suffix)
+        except OSError as e:
+            self.stats["disk_errors"] += 1
+            print(f"[TTS] Cache read failed: {e}")
+            data = None
+        if data is not None:
+            self._put_memory(mem_key, data)
+            self.stats["disk_hits"] += 1
+            self.stats["bytes_saved"] += len(data)
+            return data, "disk"
+        return None
+
+    async def put(self, key: str, data: bytes, suffix: str = "wav") -> None:
+        self._put_memory(f"{key}.{suffix}", data)
+        try:
+            await asyncio.to_thread(self._write_disk, key, suffix, data)
+            await self._maybe_prune(len(data))
+        except OSError as e:
+            self.stats["disk_errors"] += 1
+            print(f"[TTS] Cache write failed: {e}")
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[bytes]],
+        suffix: str = "wav",
+    ) -> Tuple[bytes, str]:
+        """
+        キャッシュ済みならそれを返し、未キャッシュなら compute() を 1 回だけ実行して両方の段に保存する
+        戻り値は (音声データ, "memory" | "disk" | "coalesced" | "miss")
+        """
+        cached = await self.get(key, suffix)
+        if cached is not None:
+            return cached
+
+        inflight_key = f"{key}.{suffix}"
+        task = self._inflight.get(inflight_key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            data = await self._wait(inflight_key, task)
+            self.stats["bytes_saved"] += len(data)
+            return data, "coalesced"
+
+        self.stats["misses"] += 1
+
+        async def _compute_and_store() -> bytes:
+            data = await compute()
+            await self.put(key, data, suffix)
+            return data
+
+        task = asyncio.ensure_future(_compute_and_store())
+        self._inflight[inflight_key] = task
+        task.add_done_callback(lambda t: self._forget(inflight_key, t))
+        return await self._wait(inflight_key, task), "miss"
+
+    def _forget(self, inflight_key: str, task: asyncio.Future) -> None:
+        # 止めた後に同じキーで始まった合成は消さない
+        if self._inflight.get(inflight_key) is task:
+            del self._inflight[inflight_key]
+
+    async def _wait(self, inflight_key: str, task: asyncio.Future) -> bytes:
+        """
+        合成中のタスクを待つ。先行リクエストがキャンセルされても、まだ待っている
+        リクエストがあれば合成とキャッシュへの保存は続け、誰も待っていなければ合成を止める
+        """
+        self._waiters[inflight_key] = self._waiters.get(inflight_key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[inflight_key] -= 1
+            if self._waiters[inflight_key] == 0:
+                del self._waiters[inflight_key]
+                if not task.done():
+                    # 止めたタスクに後から来たリクエストが合流しないよう、すぐに外す
+                    self._forget(inflight_key, task)
+                    task.cancel()
+                    self.stats["cancelled"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["coalesced"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_bytes": self._disk_bytes,
+            "inflight": len(self._inflight),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_ENTRIES, TTS_CACHE_MAX_BYTES, TTS_CACHE_DISK_MAX_BYTES)
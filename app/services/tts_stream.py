@@ -0,0 +1,169 @@
+# app/services/tts_stream.py
+import os
+import asyncio
+import struct
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+# 文単位のストリーミング TTS の設定
+# 同時に合成する（合成済みで未送信のものを含む）チャンク数
+TTS_STREAM_CONCURRENCY = int(os.getenv("TTS_STREAM_CONCURRENCY", "3"))
+# 句点が来なくてもこの文字数で区切る
+TTS_STREAM_MAX_CHUNK_CHARS = int(os.getenv("TTS_STREAM_MAX_CHUNK_CHARS", "100"))
+
+# 文末とみなす文字と、文末の直後に続けてよい閉じ括弧など
+_SENTENCE_ENDS = set("。．！？!?…♪")
+_CLOSERS = set("」』）)】〉》\"'”’")
+# 長すぎる文を切るときの候補
+_SOFT_BREAKS = set("、，,；;：: 　")
+
+def _speakable(chunk: str) -> bool:
+    """句読点や記号だけのチャンクは合成しない"""
+    return any(ch.isalnum() for ch in chunk)
+
+class SentenceSplitter:
+    """
+    テキストを文（。！？ や改行）の区切りで分ける
+    feed() に少しずつ渡しても（LLM の delta）、まとめて渡しても同じ結果になる
+    """
+
+    def __init__(self, max_chars: int = TTS_STREAM_MAX_CHUNK_CHARS):
+        self.max_chars = max_chars
+        self._buf = ""
+
+    def _take(self, final: bool) -> List[str]:
+        chunks: List[str] = []
+        buf = self._buf
+        start = 0
+        i = 0
+        while i < len(buf):
+            ch = buf[i]
+            end: Optional[int] = None
+            if ch == "\n":
+                end = i + 1
+            elif ch in _SENTENCE_ENDS:
+                j = i + 1
+                while j < len(buf) and (buf[j] in _SENTENCE_ENDS or buf[j] in _CLOSERS):
+                    j += 1
+                if j == len(buf) and not final:
+                    # 「！？」や閉じ括弧が続きの delta で来るかもしれないので待つ
+                    break
+                end = j
+            elif i + 1 - start >= self.max_chars:
+                # 句点が来ないまま長くなったら読点などで切る（なければその位置で切る）
+                soft = max((k for k in range(start, i + 1) if buf[k] in _SOFT_BREAKS), default=-1)
+                end = soft + 1 if soft >= start else i + 1
+
+            if end is None:
+                i += 1
+                continue
+            chunk = buf[start:end].strip()
+            if _speakable(chunk):
+                chunks.append(chunk)
+            start = i = end
+
+        rest = buf[start:]
+        if final:
+            rest = rest.strip()
+            if _speakable(rest):
+                chunks.append(rest)
+            rest = ""
+        self._buf = rest
+        return chunks
+
+    def feed(self, text: str) -> List[str]:
+        """text を追加し、確定した文を返す"""
+        self._buf += text
+        return self._take(final=False)
+
+    def flush(self) -> List[str]:
+        """残りをすべて返す（入力の終わり）"""
+        return self._take(final=True)
+
+def split_sentences(text: str, max_chars: int = TTS_STREAM_MAX_CHUNK_CHARS) -> List[str]:
+    splitter = SentenceSplitter(max_chars)
+    return splitter.feed(text) + splitter.flush()
+
+async def iter_sentences(texts: AsyncIterator[str], max_chars: int = TTS_STREAM_MAX_CHUNK_CHARS) -> AsyncGenerator[str, None]:
+    """テキストの断片（LLM の delta など）を受け取り、文がそろうたびに返す"""
+    splitter = SentenceSplitter(max_chars)
+    async for text in texts:
+        for sentence in splitter.feed(text):
+            yield sentence
+    for sentence in splitter.flush():
+        yield sentence
+
+def parse_wav(data: bytes) -> Tuple[bytes, bytes]:
+    """WAV を (fmt チャンクの中身, PCM データ) に分ける"""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+    fmt: Optional[bytes] = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+        body = data[pos + 8:pos + 8 + size]
+        if chunk_id == b"fmt ":
+            fmt = body
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAV data chunk before fmt chunk")
+            return fmt, body
+        pos += 8 + size + (size & 1)
+    raise ValueError("WAV data chunk not found")
+
+def wav_stream_header(fmt: bytes) -> bytes:
+    """長さ未定の WAV ストリームのヘッダ（RIFF / data のサイズは最大値にする）"""
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+async def stream_sentence_audio(
+    sentences: AsyncIterator[str],
+    synthesize: Callable[[str], Awaitable[bytes]],
+    concurrency: int = TTS_STREAM_CONCURRENCY,
+) -> AsyncGenerator[bytes, None]:
+    """
+    文ごとに合成した WAV を 1 本の WAV ストリーム（ヘッダ + PCM の連結）として順番どおりに返す
+    最大 concurrency 個の文を先行して並列に合成し、前の文を送っている間に次の文の合成を進める
+    文の読み出しは別タスクで行うので、LLM の生成待ちで合成済みの音声の送信が止まることはない
+    """
+    queue: "asyncio.Queue[Optional[asyncio.Future]]" = asyncio.Queue()
+    window = asyncio.Semaphore(concurrency)
+
+    async def produce() -> None:
+        try:
+            async for sentence in sentences:
+                await window.acquire()
+                queue.put_nowait(asyncio.ensure_future(synthesize(sentence)))
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    fmt: Optional[bytes] = None
+    try:
+        while True:
+            task = await queue.get()
+            if task is None:
+                break
+            try:
+                data = await task
+            finally:
+                window.release()
+            chunk_fmt, pcm = parse_wav(data)
+            if fmt is None:
+                fmt = chunk_fmt
+                yield wav_stream_header(fmt)
+            elif chunk_fmt != fmt:
+                raise ValueError("Audio format changed between chunks")
+            yield pcm
+        # 文の読み出し側のエラーを伝える
+        await producer
+    finally:
+        # 途中で抜けた（切断・エラー）場合は先行している合成を止める
+        producer.cancel()
+        while not queue.empty():
+            task = queue.get_nowait()
+            if task is not None:
+                task.cancel()
@@ -0,0 +1,292 @@
+# app/services/voicevox.py
+import os
+import math
+import time
+import asyncio
+from typing import Any, Dict, Optional, Tuple
+import httpx
+from fastapi import HTTPException
+from app.services.audio_encode import encode_audio, format_params
+from app.services.tts_cache import TTS_CACHE_ENABLED, make_tts_key, normalize_text, tts_cache
+
+# VOICEVOX Web API エンドポイント
+VOICEVOX_API_BASE = os.getenv("VOICEVOX_API_BASE", "https://deprecatedapis.tts.quest/v2/voicevox")
+
+# 共有 HTTP クライアント設定
+VOICEVOX_MAX_CONNECTIONS = int(os.getenv("VOICEVOX_MAX_CONNECTIONS", "20"))
+VOICEVOX_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("VOICEVOX_MAX_KEEPALIVE_CONNECTIONS", "10"))
+VOICEVOX_CONNECT_TIMEOUT = float(os.getenv("VOICEVOX_CONNECT_TIMEOUT", "5"))
+VOICEVOX_TIMEOUT = float(os.getenv("VOICEVOX_TIMEOUT", "30"))
+VOICEVOX_SPEAKERS_TIMEOUT = float(os.getenv("VOICEVOX_SPEAKERS_TIMEOUT", "10"))
+
+# 話者一覧のキャッシュ（TTL を過ぎても STALE の間は古い一覧を返しつつ裏で更新する）
+VOICEVOX_SPEAKERS_TTL = float(os.getenv("VOICEVOX_SPEAKERS_TTL", "3600"))
+VOICEVOX_SPEAKERS_STALE = float(os.getenv("VOICEVOX_SPEAKERS_STALE", "86400"))
+
+# サーキットブレーカー（連続 THRESHOLD 回失敗したら COOLDOWN 秒は VOICEVOX に送らない）
+VOICEVOX_BREAKER_THRESHOLD = int(os.getenv("VOICEVOX_BREAKER_THRESHOLD", "5"))
+VOICEVOX_BREAKER_COOLDOWN = float(os.getenv("VOICEVOX_BREAKER_COOLDOWN", "30"))
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    """
+    プロセス共有の AsyncClient を返す（未作成・クローズ済みなら作り直す）
+    通常は app の lifespan 開始時に作成される
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=VOICEVOX_MAX_CONNECTIONS,
+                max_keepalive_connections=VOICEVOX_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(VOICEVOX_TIMEOUT, connect=VOICEVOX_CONNECT_TIMEOUT),
+        )
+    return _client
+
+async def close_client() -> None:
+    """lifespan 終了時に共有クライアントを閉じる"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いていて VOICEVOX に送らなかった（503 + Retry-After で返す）"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("VOICEVOX is temporarily unavailable")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    closed: 通常どおり送る。連続 threshold 回失敗で open
+    open: cooldown 秒は送らずに CircuitOpenError。経過後は half_open
+    half_open: 1 リクエストだけ試しに送り、成功なら closed、失敗なら再び open
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.stats = {"failures": 0, "opened": 0, "rejected": 0}
+
+    def before_request(self) -> None:
+        if self.state == "open":
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(max(1, math.ceil(remaining)))
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(1)
+            self._probing = True
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probing = False
+        self.state = "closed"
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probing = False
+        self.stats["failures"] += 1
+        if self.state == "half_open" or self._failures >= self.threshold:
+            if self.state != "open":
+                self.stats["opened"] += 1
+                print(f"[TTS] Circuit opened for {self.cooldown:.0f}s after {self._failures} failures")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """結果が分からないまま終わった（キャンセルなど）ときに試行中の枠を返す"""
+        self._probing = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "state": self.state, "consecutive_failures": self._failures}
+
+voicevox_breaker = CircuitBreaker(VOICEVOX_BREAKER_THRESHOLD, VOICEVOX_BREAKER_COOLDOWN)
+
+async def _request(method: str, path: str, **kwargs: Any) -> httpx.Response:
+    """
+    ブレーカー経由で VOICEVOX にリクエストする
+    接続エラー・タイムアウト・5xx / 429 を失敗として数える
+    """
+    voicevox_breaker.before_request()
+    try:
+        response = await get_client().request(method, f"{VOICEVOX_API_BASE}{path}", **kwargs)
+    except httpx.TransportError:
+        voicevox_breaker.record_failure()
+        raise
+    except BaseException:
+        voicevox_breaker.release()
+        raise
+    if response.status_code >= 500 or response.status_code == 429:
+        voicevox_breaker.record_failure()
+    else:
+        voicevox_breaker.record_success()
+    return response
+
+def _http_error(e: Exception) -> HTTPException:
+    """VOICEVOX 呼び出しの例外 -> HTTPException"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if isinstance(e, httpx.TimeoutException):
+        print("[TTS] Request timeout")
+        return HTTPException(status_code=504, detail="VOICEVOX API timeout")
+    if isinstance(e, httpx.TransportError):
+        print(f"[TTS] Connection error: {e}")
+        return HTTPException(status_code=502, detail="VOICEVOX API is unreachable")
+    print(f"[TTS] Error: {e}")
+    return HTTPException(status_code=500, detail=str(e))
+
+async def synthesize(text: str, speaker: int) -> bytes:
+    """VOICEVOX Web API で音声クエリ作成 -> 音声合成（WAV のバイト列を返す）"""
+    try:
+        # 音声クエリを作成
+        query_response = await _request(
+            "POST",
+            "/audio_query",
+            params={"text": text, "speaker": speaker}
+        )
+
+        if query_response.status_code != 200:
+            print(f"[TTS] Audio query failed: {query_response.status_code}")
+            raise HTTPException(
+                status_code=query_response.status_code,
+                detail="Failed to create audio query"
+            )
+
+        audio_query = query_response.json()
+
+        # 音声合成
+        synthesis_response = await _request(
+            "POST",
+            "/synthesis",
+            params={"speaker": speaker},
+            json=audio_query
+        )
+
+        if synthesis_response.status_code != 200:
+            print(f"[TTS] Synthesis failed: {synthesis_response.status_code}")
+            raise HTTPException(
+                status_code=synthesis_response.status_code,
+                detail="Failed to synthesize audio"
+            )
+
+        return synthesis_response.content
+
+    except Exception as e:
+        raise _http_error(e)
+
+class SpeakersCache:
+    """
+    話者一覧のキャッシュ（TTL + stale-while-revalidate）
+    更新は常に 1 つのタスクだけで行い、その間のリクエストはメモリの一覧を返す
+    更新に失敗しても古い一覧があればそれを返す（degraded）
+    """
+
+    def __init__(self, ttl: float, stale: float):
+        self.ttl = ttl
+        self.stale = stale
+        self._value: Any = None
+        self._fetched_at = 0.0
+        self._refresh: Optional[asyncio.Future] = None
+        self.stats = {"fresh": 0, "stale": 0, "miss": 0, "degraded": 0, "refresh_errors": 0}
+
+    async def _fetch(self) -> Any:
+        try:
+            response = await _request("GET", "/speakers", timeout=VOICEVOX_SPEAKERS_TIMEOUT)
+            if response.status_code != 200:
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail="Failed to fetch speakers"
+                )
+            value = response.json()
+        except Exception as e:
+            self.stats["refresh_errors"] += 1
+            print(f"[TTS] Error fetching speakers: {e}")
+            raise _http_error(e)
+        self._value = value
+        self._fetched_at = time.monotonic()
+        return value
+
+    def _start_refresh(self) -> asyncio.Future:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._fetch())
+            # 誰も待っていない裏の更新の失敗はログだけ（_fetch で出力済み）
+            self._refresh.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return self._refresh
+
+    async def get(self) -> Tuple[Any, str]:
+        """(話者一覧, "fresh" | "stale" | "miss" | "degraded")"""
+        if self._value is not None:
+            age = time.monotonic() - self._fetched_at
+            if age < self.ttl:
+                self.stats["fresh"] += 1
+                return self._value, "fresh"
+            if age < self.ttl + self.stale:
+                self._start_refresh()
+                self.stats["stale"] += 1
+                return self._value, "stale"
+
+        try:
+            value = await asyncio.shield(self._start_refresh())
+        except HTTPException:
+            if self._value is None:
+                raise
+            self.stats["degraded"] += 1
+            return self._value, "degraded"
+        self.stats["miss"] += 1
+        return value, "miss"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "cached": self._value is not None,
+            "age_seconds": time.monotonic() - self._fetched_at if self._value is not None else None,
+        }
+
+speakers_cache = SpeakersCache(VOICEVOX_SPEAKERS_TTL, VOICEVOX_SPEAKERS_STALE)
+
+def voicevox_snapshot() -> Dict[str, Any]:
+    """VOICEVOX のブレーカーと話者一覧キャッシュの状態"""
+    return {"breaker": voicevox_breaker.snapshot(), "speakers": speakers_cache.snapshot()}
+
+async def cached_audio(text: str, speaker: int, audio_format: str = "wav") -> Tuple[bytes, str, str]:
+    """
+    (正規化テキスト, 話者, 形式) の音声をキャッシュから返す。なければ合成（と変換）してキャッシュする
+    wav 以外はキャッシュ済みの WAV を変換して、変換後のデータも別のエントリとして保存する
+    戻り値は (音声データ, キャッシュキー, キャッシュの状態)
+    """
+    normalized = normalize_text(text)
+    # テキストが空の場合はエラー
+    if not normalized:
+        raise HTTPException(status_code=400, detail="Text is required")
+
+    if audio_format == "wav":
+        key = make_tts_key(VOICEVOX_API_BASE, normalized, speaker)
+        compute = lambda: synthesize(normalized, speaker)
+    else:
+        key = make_tts_key(VOICEVOX_API_BASE, normalized, speaker, **format_params(audio_format))
+
+        async def compute() -> bytes:
+            wav, _, _ = await cached_audio(normalized, speaker)
+            try:
+                return await encode_audio(wav, audio_format)
+            except (RuntimeError, asyncio.TimeoutError) as e:
+                print(f"[TTS] Encode failed: {e!r}")
+                raise HTTPException(status_code=500, detail="Failed to encode audio")
+
+    if not TTS_CACHE_ENABLED:
+        return await compute(), key, "bypass"
+    data, status = await tts_cache.get_or_compute(key, compute, suffix=audio_format)
+    return data, key, status
@@ -0,0 +1,109 @@
+# app/services/xlsx_patch.py
+import io
+import re
+import zipfile
+import posixpath
+from typing import Dict, List, Tuple, Union
+from xml.sax.saxutils import escape
+
+# セルに書き込める値（None は値を消す）
+CellValue = Union[int, float, str, None]
+
+_CELL_RE = re.compile(r'<c r="([A-Z]+[0-9]+)"([^>]*?)(?:/>|>.*?</c>)', re.S)
+_STYLE_RE = re.compile(r'\ss="([0-9]+)"')
+# 数式セルのキャッシュ値（テンプレート作成時の計算結果）
+_FORMULA_VALUE_RE = re.compile(r'(<f[^>]*/>|<f[^>]*>.*?</f>)(?:<v/>|<v>.*?</v>)', re.S)
+_CALC_PR_RE = re.compile(r'<calcPr\b([^>]*?)(/?)>')
+_FIRST_SHEET_RE = re.compile(r'<sheet\b[^>]*\br:id="([^"]+)"')
+
+def _rel_target(rels_xml: str, rel_id: str) -> str:
+    for rel in re.finditer(r'<Relationship\b[^>]*>', rels_xml):
+        tag = rel.group(0)
+        if f'Id="{rel_id}"' in tag:
+            target = re.search(r'Target="([^"]+)"', tag).group(1)
+            return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+    raise ValueError(f"Relationship {rel_id} not found")
+
+def _cell_xml(ref: str, attrs: str, value: CellValue) -> str:
+    """既存セルの属性のうちスタイル (s) だけを引き継いで新しい値のセルを作る"""
+    style = _STYLE_RE.search(attrs)
+    s = f' s="{style.group(1)}"' if style else ""
+    if value is None:
+        return f'<c r="{ref}"{s}/>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{s}><v>{value!r}</v></c>'
+    space = ' xml:space="preserve"' if value != value.strip() else ""
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+class XlsxTemplate:
+    """
+    xlsx テンプレートの先頭シートのセル値だけを書き換えて出力する
+    シートの XML と workbook.xml 以外の zip のメンバーは、最初に作った zip をそのままコピーする
+    書き換えるセルはテンプレートに存在している必要がある（なければ KeyError）
+    """
+
+    def __init__(self, data: bytes):
+        with zipfile.ZipFile(io.BytesIO(data)) as zin:
+            workbook_xml = zin.read("xl/workbook.xml").decode("utf-8")
+            rels_xml = zin.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+            first_sheet = _FIRST_SHEET_RE.search(workbook_xml)
+            if first_sheet is None:
+                raise ValueError("Workbook has no sheets")
+            self.sheet_path = _rel_target(rels_xml, first_sheet.group(1))
+            sheet_xml = zin.read(self.sheet_path).decode("utf-8")
+
+            # 変更しないメンバーだけの zip を作っておき、出力のたびにこれに 2 つのメンバーを追記する
+            base = io.BytesIO()
+            with zipfile.ZipFile(base, "w") as zout:
+                for info in zin.infolist():
+                    if info.filename in (self.sheet_path, "xl/workbook.xml"):
+                        continue
+                    zout.writestr(info, zin.read(info.filename), compress_type=info.compress_type)
+            self._base = base.getvalue()
+            # writestr は渡した ZipInfo を書き換える（サイズ・CRC・オフセット）ので、共有せず日時だけ持っておく
+            # （ATTENDANCE_EXECUTOR=thread では同じテンプレートを複数スレッドが同時に使う）
+            self._sheet_date_time = zin.getinfo(self.sheet_path).date_time
+            self._workbook_date_time = zin.getinfo("xl/workbook.xml").date_time
+
+        # 数式のキャッシュ値はテンプレートの値なので消し、開いたときに再計算させる（openpyxl の出力と同じ）
+        self._sheet_xml = _FORMULA_VALUE_RE.sub(r"\1", sheet_xml)
+        self._workbook_xml = _CALC_PR_RE.sub(
+            lambda m: m.group(0) if "fullCalcOnLoad" in m.group(1) else f'<calcPr{m.group(1)} fullCalcOnLoad="1"{m.group(2)}>',
+            workbook_xml,
+            count=1,
+        ).encode("utf-8")
+        # セル参照 -> (開始位置, 終了位置, 属性)
+        self._cells: Dict[str, Tuple[int, int, str]] = {
+            m.group(1): (m.start(), m.end(), m.group(2)) for m in _CELL_RE.finditer(self._sheet_xml)
+        }
+
+    def render(self, values: Dict[str, CellValue]) -> bytes:
+        """values のセルだけを書き換えた xlsx のバイト列を返す"""
+        targets: List[Tuple[int, int, str]] = []
+        for ref, value in values.items():
+            start, end, attrs = self._cells[ref]
+            targets.append((start, end, _cell_xml(ref, attrs, value)))
+        targets.sort()
+
+        pieces: List[str] = []
+        pos = 0
+        for start, end, cell in targets:
+            pieces.append(self._sheet_xml[pos:start])
+            pieces.append(cell)
+            pos = end
+        pieces.append(self._sheet_xml[pos:])
+
+        out = io.BytesIO(self._base)
+        with zipfile.ZipFile(out, "a") as zout:
+            zout.writestr(self._member("xl/workbook.xml", self._workbook_date_time), self._workbook_xml)
+            zout.writestr(self._member(self.sheet_path, self._sheet_date_time), "".join(pieces).encode("utf-8"))
+        return out.getvalue()
+
+    @staticmethod
+    def _member(filename: str, date_time: Tuple[int, ...]) -> zipfile.ZipInfo:
+        """出力ごとに新しい ZipInfo を作る"""
+        info = zipfile.ZipInfo(filename, date_time=date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
@@ -0,0 +1,47 @@
+# app/services/zip_stream.py
+import io
+import time
+import zipfile
+
+class _ChunkBuffer(io.RawIOBase):
+    """
+    zipfile の書き込み先（シークできないストリーム）
+    書かれたバイト列をためておき、take() で取り出す
+    """
+
+    def __init__(self):
+        self._chunks = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks += data
+        return len(data)
+
+    def take(self) -> bytes:
+        data = bytes(self._chunks)
+        self._chunks.clear()
+        return data
+
+class ZipStreamWriter:
+    """
+    ZIP をメンバーごとに少しずつ作る
+    add() / close() が返すバイト列を順に送ると 1 つの ZIP になる（全体をメモリに持たない）
+    シークできないのでローカルヘッダの後にデータ記述子（CRC・サイズ）を書く形式になる
+    """
+
+    def __init__(self, compression: int = zipfile.ZIP_STORED):
+        self._buf = _ChunkBuffer()
+        self._zip = zipfile.ZipFile(self._buf, "w", compression=compression)
+
+    def add(self, name: str, data: bytes) -> bytes:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = self._zip.compression
+        self._zip.writestr(info, data)
+        return self._buf.take()
+
+    def close(self) -> bytes:
+        """セントラルディレクトリを書いて終わりの部分を返す"""
+        self._zip.close()
+        return self._buf.take()
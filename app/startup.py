@@ -0,0 +1,139 @@
+# app/startup.py
+import os
+import sys
+import time
+import importlib.abc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# 起動時間の計測（ワーカーの起動・再起動の遅さの回帰を追うためのもの）
+# true にすると python -X importtime のようにモジュールごとの import 時間も記録する
+STARTUP_PROFILE_IMPORTS = os.getenv("STARTUP_PROFILE_IMPORTS", "false").lower() == "true"
+STARTUP_REPORT_TOP = int(os.getenv("STARTUP_REPORT_TOP", "30"))
+# 起動時には読み込まれていないはずの重いモジュール（使うときに読み込む）
+LAZY_MODULES = ("openpyxl",)
+
+# 基準時刻（main.py で最初に import される時点）
+_started_at = time.perf_counter()
+_phases: List[Dict[str, Any]] = []
+_ready_ms: Optional[float] = None
+
+# import の計測結果: モジュール名 -> [自身の時間, 子を含む時間, 深さ]（ミリ秒）
+_imports: Dict[str, List[float]] = {}
+_import_order: List[str] = []
+_import_stack: List[List[float]] = []
+
+def _elapsed_ms() -> float:
+    return (time.perf_counter() - _started_at) * 1000
+
+class _TimedLoader(importlib.abc.Loader):
+    """
+    モジュールの実行（exec_module）にかかった時間を記録するローダーのラッパー
+    実行前にモジュールの __loader__ / __spec__.loader を元のローダーに戻すので、読み込み後にラッパーは残らない
+    """
+
+    def __init__(self, loader: Any, find_ms: float):
+        self._loader = loader
+        self._find_ms = find_ms
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        name = module.__name__
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+
+        _imports[name] = [0.0, 0.0, float(len(_import_stack))]
+        _import_order.append(name)
+        frame = [0.0]  # 子モジュールの import にかかった時間
+        _import_stack.append(frame)
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            # モジュールの検索にかかった時間も含める（-X importtime と同じ）
+            cumulative = (time.perf_counter() - started) * 1000 + self._find_ms
+            _import_stack.pop()
+            if _import_stack:
+                _import_stack[-1][0] += cumulative
+            _imports[name][0] = cumulative - frame[0]
+            _imports[name][1] = cumulative
+
+    def __getattr__(self, attr: str) -> Any:
+        # get_resource_reader / get_source などは元のローダーに任せる
+        return getattr(self._loader, attr)
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """sys.meta_path の先頭に入れ、残りのファインダーで見つけたモジュールのローダーを _TimedLoader で包む"""
+
+    def find_spec(self, fullname, path, target=None):
+        started = time.perf_counter()
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, "find_spec", None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimedLoader(spec.loader, (time.perf_counter() - started) * 1000)
+            return spec
+        return None
+
+_import_timer = _ImportTimer()
+
+def install_import_profiler() -> None:
+    """
+    STARTUP_PROFILE_IMPORTS のときだけ import の計測を始める（finish() で止める）
+    import 文・from パッケージ import サブモジュール・importlib.import_module のどれで読み込まれても記録される
+    """
+    if STARTUP_PROFILE_IMPORTS and _import_timer not in sys.meta_path:
+        sys.meta_path.insert(0, _import_timer)
+
+def mark(name: str) -> None:
+    """基準時刻からの経過時間を記録する（import の完了など）"""
+    _phases.append({"name": name, "at_ms": _elapsed_ms(), "ms": None})
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """処理にかかった時間を記録する（lifespan の各ステップ）"""
+    at = _elapsed_ms()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append({"name": name, "at_ms": at, "ms": (time.perf_counter() - started) * 1000})
+
+def finish() -> None:
+    """起動完了（lifespan の yield の直前）。import の計測を止めて要約をログに出す"""
+    global _ready_ms
+    if _import_timer in sys.meta_path:
+        sys.meta_path.remove(_import_timer)
+    _ready_ms = _elapsed_ms()
+    steps = ", ".join(f"{p['name']} {p['ms'] if p['ms'] is not None else p['at_ms']:.0f}ms" for p in _phases)
+    print(f"[STARTUP] Ready in {_ready_ms:.0f} ms ({steps})")
+
+def report() -> Dict[str, Any]:
+    """起動時間の内訳（/health/startup で返す）"""
+    top = sorted(_import_order, key=lambda m: _imports[m][1], reverse=True)[:STARTUP_REPORT_TOP]
+    return {
+        "pid": os.getpid(),
+        "ready_ms": _ready_ms,
+        "phases": _phases,
+        "imports": {
+            "profiled": STARTUP_PROFILE_IMPORTS,
+            "modules": len(_import_order),
+            "top": [
+                {
+                    "module": m,
+                    "self_ms": round(_imports[m][0], 3),
+                    "cumulative_ms": round(_imports[m][1], 3),
+                    "depth": int(_imports[m][2]),
+                }
+                for m in top
+            ],
+        },
+        "lazy_modules_loaded": {name: name in sys.modules for name in LAZY_MODULES},
+    }
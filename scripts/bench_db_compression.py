@@ -0,0 +1,98 @@
+# scripts/bench_db_compression.py
+"""
+会話ノードの圧縮保存のベンチマーク（DB ファイルのサイズと保存 / 読み込み / 検索の CPU 時間）
+
+    python -m scripts.bench_db_compression [会話数] [1 会話あたりの往復数]
+
+一時ディレクトリに本文の圧縮なし（DB_COMPRESS_CONTENT_MIN_BYTES=0）とありの 2 つの DB を作って比べる
+圧縮ありの下限は DB_COMPRESS_CONTENT_MIN_BYTES の設定値（未設定なら 256 バイト）
+"""
+import sys
+import time
+import random
+import tempfile
+from pathlib import Path
+
+from app import database
+
+_JA = [
+    "承知しました。順番に説明します。",
+    "まず、設定ファイルの読み込み順序を確認してください。",
+    "環境変数が優先されるため、.env の値は上書きされます。",
+    "次に、データベースの接続プールの大きさを見直します。",
+    "同時接続数がワーカー数より少ないと待ちが発生します。",
+    "この関数は例外を握りつぶしているので、ログを確認する必要があります。",
+]
+_EN = [
+    "Here is an example of how to configure the retry policy.",
+    "The connection is reused across requests, so the handshake cost is paid once.",
+    "You can pass the cursor from the previous page to fetch the next one.",
+]
+_CODE = "```python\ndef handler(request):\n    data = request.json()\n    return {\"ok\": True, \"items\": data.get(\"items\", [])}\n```"
+
+def make_tree(rng: random.Random, turns: int) -> dict:
+    nodes = {"0": {"id": 0, "parentId": None, "children": [1], "message": None}}
+    path = [0]
+    for i in range(1, turns * 2 + 1):
+        if i % 2:
+            content = rng.choice(_JA) + rng.choice(_EN)
+        else:
+            parts = rng.choices(_JA, k=rng.randint(4, 12)) + rng.choices(_EN, k=rng.randint(1, 4))
+            if rng.random() < 0.3:
+                parts.append(_CODE)
+            content = "\n".join(parts)
+        nodes[str(i)] = {
+            "id": i,
+            "parentId": i - 1,
+            "children": [i + 1] if i < turns * 2 else [],
+            "message": {"role": "user" if i % 2 else "assistant", "content": content, "timestamp": time.time()},
+        }
+        path.append(i)
+    return {"nodes": nodes, "currentPath": path}
+
+def run(label: str, directory: Path, min_bytes: int, trees: list) -> None:
+    database.close_pool()
+    database.DB_PATH = directory / f"{label}.db"
+    database.DB_COMPRESS_CONTENT_MIN_BYTES = min_bytes
+    database.ensure_schema()
+
+    started = time.process_time()
+    for i, tree in enumerate(trees):
+        database.save_conversation(f"c{i}", "bench", tree, title=f"会話 {i}")
+    save_s = time.process_time() - started
+
+    started = time.process_time()
+    for i in range(len(trees)):
+        database.get_conversation(f"c{i}", "bench")
+    load_s = time.process_time() - started
+
+    started = time.process_time()
+    for term in ("接続プール", "handshake", "ログを確認"):
+        database.search_conversations("bench", term)
+    search_s = time.process_time() - started
+
+    with database.get_db() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        stored, raw = conn.execute(
+            "SELECT SUM(length(CAST(content AS BLOB))), SUM(length(CAST(unpack_text(content) AS BLOB))) FROM conversation_nodes"
+        ).fetchone()
+        conn.execute("VACUUM")
+    database.close_pool()
+    size = database.DB_PATH.stat().st_size
+    print(
+        f"{label:>12}: db {size / 1024:8.0f} KiB  content {stored / 1024:7.0f} / {raw / 1024:7.0f} KiB "
+        f"({stored / raw:.0%})  save {save_s * 1000:6.0f} ms  load {load_s * 1000:6.0f} ms  search {search_s * 1000:5.0f} ms"
+    )
+
+def main() -> None:
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    min_bytes = database.DB_COMPRESS_CONTENT_MIN_BYTES or 256
+    rng = random.Random(0)
+    trees = [make_tree(rng, turns) for _ in range(conversations)]
+    with tempfile.TemporaryDirectory() as tmp:
+        run("uncompressed", Path(tmp), 0, trees)
+        run("compressed", Path(tmp), min_bytes, trees)
+
+if __name__ == "__main__":
+    main()
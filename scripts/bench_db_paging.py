@@ -0,0 +1,99 @@
+# scripts/bench_db_paging.py
+"""
+会話一覧のキーセットページング（?after=）のベンチマーク
+
+    python -m scripts.bench_db_paging [会話数] [ページサイズ] [繰り返し回数]
+
+一時ディレクトリの DB に 1 ユーザー分の会話（と別ユーザーの会話を 1 割）を入れ、
+先頭・中間・末尾のページを list_conversations と /api/conversations/list の両方で測る（中央値）
+エンドポイントの時間には ETag 用の get_list_version（ユーザーの全件の集計）も含まれるので別に測る
+比較として同じ位置を OFFSET で読んだ場合も測る
+"""
+import sys
+import time
+import tempfile
+import statistics
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+from app import database
+from app.routers.conversations import encode_cursor
+
+USER = "bench"
+
+def seed(count: int) -> None:
+    """一覧は conversations だけを読むので、ノードは作らずに直接入れる"""
+    rows = [(f"c{i:06d}", USER, f"会話 {i}", "2024-01-01 00:00:00", i) for i in range(count)]
+    rows += [(f"o{i:06d}", "other", f"会話 {i}", "2024-01-01 00:00:00", i) for i in range(count // 10)]
+    with database.get_db() as conn:
+        conn.executemany("""
+            INSERT INTO conversations (id, user_id, title, created_at, updated_at, conversation_tree)
+            VALUES (?, ?, ?, ?, datetime('2024-01-01', '+' || ? || ' seconds'), '{}')
+        """, rows)
+        conn.execute("ANALYZE")
+
+def median_ms(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        database.close_pool()
+        database.DB_PATH = Path(tmp) / "paging.db"
+        database.ensure_schema()
+        seed(count)
+
+        with database.get_db() as conn:
+            ordered = conn.execute("""
+                SELECT updated_at, id FROM conversations WHERE user_id = ?
+                ORDER BY updated_at DESC, id DESC
+            """, (USER,)).fetchall()
+            plan = conn.execute("""
+                EXPLAIN QUERY PLAN
+                SELECT id, title, created_at, updated_at FROM conversations
+                WHERE user_id = ? AND (updated_at, id) < (?, ?)
+                ORDER BY updated_at DESC, id DESC LIMIT ?
+            """, (USER, ordered[0][0], ordered[0][1], page_size)).fetchall()
+        print(f"{len(ordered)} conversations for one user; plan: {' / '.join(row[3] for row in plan)}")
+
+        version_ms = median_ms(lambda: database.get_list_version(USER), repeat)
+        print(f"get_list_version (ETag, every request): {version_ms:.2f} ms")
+
+        from app.main import app
+        with TestClient(app) as client:
+            headers = {"x-ms-client-principal-name": USER}
+            for label, offset in (("first", 0), ("middle", len(ordered) // 2), ("last", len(ordered) - page_size)):
+                after = None if offset == 0 else (ordered[offset - 1][0], ordered[offset - 1][1])
+                params = {"limit": page_size}
+                if after is not None:
+                    params["after"] = encode_cursor(*after)
+
+                keyset_ms = median_ms(lambda: database.list_conversations(USER, page_size + 1, after), repeat)
+                endpoint_ms = median_ms(lambda: client.get("/api/conversations/list", params=params, headers=headers), repeat)
+
+                def by_offset():
+                    with database.get_db() as conn:
+                        conn.execute("""
+                            SELECT id, title, created_at, updated_at FROM conversations
+                            WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ? OFFSET ?
+                        """, (USER, page_size + 1, offset)).fetchall()
+                offset_ms = median_ms(by_offset, repeat)
+
+                page = client.get("/api/conversations/list", params=params, headers=headers).json()
+                assert page[0]["id"] == ordered[offset][1], label
+                print(
+                    f"{label:>6} page (offset {offset:6d}): keyset {keyset_ms:6.2f} ms  "
+                    f"endpoint {endpoint_ms:6.2f} ms  OFFSET {offset_ms:7.2f} ms"
+                )
+        database.close_pool()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# scripts/bench_db_pool.py
+"""
+接続プール（WAL + チューニング済み PRAGMA）のベンチマーク（保存 / 一覧の 1 秒あたりの回数）
+
+    python -m scripts.bench_db_pool [保存回数] [一覧回数] [スレッド数]
+
+一時ディレクトリに、操作ごとに接続を開いて閉じる（プール導入前の get_db、ロールバックジャーナル）DB と
+プールの DB の 2 つを作って比べる。並列の欄は 1 スレッドが保存し、残りのスレッドが一覧を読む
+"""
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from app import database
+from scripts.bench_db_compression import make_tree
+
+_pooled_get_db = database.get_db
+
+@contextmanager
+def _per_call_get_db():
+    """プール導入前の get_db（操作ごとに新しい接続。PRAGMA は既定のまま）"""
+    conn = sqlite3.connect(str(database.DB_PATH))
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _rate(count: int, seconds: float) -> str:
+    return f"{count / seconds:7.0f}/s"
+
+def run(label: str, directory: Path, pooled: bool, trees: list, lists: int, threads: int) -> None:
+    database.close_pool()
+    database.DB_PATH = directory / f"{label}.db"
+    database.get_db = _pooled_get_db if pooled else _per_call_get_db
+    database.ensure_schema()
+
+    started = time.perf_counter()
+    for i, tree in enumerate(trees):
+        database.save_conversation(f"c{i}", "bench", tree, title=f"会話 {i}")
+    save_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(lists):
+        database.list_conversations("bench", limit=50)
+    list_s = time.perf_counter() - started
+
+    # 並列: 1 スレッドが上書き保存を続け、残りのスレッドが一覧を読む
+    stop = threading.Event()
+    counts = [0] * threads
+
+    def writer() -> None:
+        i = 0
+        while not stop.is_set():
+            database.save_conversation(f"c{i % len(trees)}", "bench", trees[i % len(trees)], title=f"会話 {i}")
+            counts[0] += 1
+            i += 1
+
+    def reader(slot: int) -> None:
+        while not stop.is_set():
+            database.list_conversations("bench", limit=50)
+            counts[slot] += 1
+
+    workers = [threading.Thread(target=writer)] + [
+        threading.Thread(target=reader, args=(slot,)) for slot in range(1, threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(2.0)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    mixed_s = time.perf_counter() - started
+
+    database.close_pool()
+    database.get_db = _pooled_get_db
+    print(
+        f"{label:>9}: save {_rate(len(trees), save_s)}  list {_rate(lists, list_s)}  "
+        f"parallel save {_rate(counts[0], mixed_s)} + list {_rate(sum(counts[1:]), mixed_s)} ({threads} threads)"
+    )
+
+def main() -> None:
+    saves = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    lists = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else database.DB_POOL_SIZE
+    rng = random.Random(0)
+    trees = [make_tree(rng, 5) for _ in range(saves)]
+    with tempfile.TemporaryDirectory() as tmp:
+        run("per-call", Path(tmp), False, trees, lists, threads)
+        run("pooled", Path(tmp), True, trees, lists, threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# scripts/bench_db_search.py
+"""
+会話検索（search_conversations）のベンチマーク
+
+    python -m scripts.bench_db_search [会話数] [1 会話あたりの往復数] [繰り返し回数]
+
+一時ディレクトリの DB に 1 ユーザー分の会話を作り、検索語ごとの所要時間（中央値）を測る
+3 文字以上の語は FTS5、2 文字以下の語は直近の会話を順に調べる経路を通る
+"""
+import sys
+import time
+import random
+import tempfile
+import statistics
+from pathlib import Path
+
+from app import database
+from scripts.bench_db_compression import make_tree
+
+# よく出る語・まれな語・一致しない語・2 文字以下の語
+TERMS = ["接続プール", "ログを確認", "handshake", "retry policy", "存在しない語句", "環境", "DB"]
+
+def main() -> None:
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.close_pool()
+        database.DB_PATH = Path(tmp) / "search.db"
+        database.ensure_schema()
+        started = time.perf_counter()
+        for i in range(conversations):
+            database.save_conversation(f"c{i}", "bench", make_tree(rng, turns), title=f"会話 {i}")
+        print(f"seeded {conversations} conversations x {turns} turns in {time.perf_counter() - started:.1f} s")
+
+        for term in TERMS:
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                results = database.search_conversations("bench", term)
+                timings.append(time.perf_counter() - started)
+            print(f"{term:>14}: {statistics.median(timings) * 1000:8.1f} ms  ({len(results)} results)")
+        database.close_pool()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# tests/test_context.py
+import asyncio
+
+import pytest
+
+from app.services import context
+
+MAX_TOKENS = 300
+BLOCK = 8
+
+@pytest.fixture
+def summarizing(monkeypatch):
+    """tiktoken を使わない概算のトークン数と、上流を呼ばない要約で fit_context を動かす"""
+    calls = []
+
+    async def fake_complete_once(messages, temperature, max_tokens):
+        calls.append(messages)
+        return {"content": "ユーザーは接続プールの設定について質問した。" * 2}
+
+    monkeypatch.setattr(context, "CONTEXT_MAX_TOKENS", MAX_TOKENS)
+    monkeypatch.setattr(context, "CONTEXT_SUMMARY_ENABLED", True)
+    monkeypatch.setattr(context, "CONTEXT_SUMMARY_BLOCK", BLOCK)
+    monkeypatch.setattr(context, "complete_once", fake_complete_once)
+    monkeypatch.setattr(context, "_encoding", None)
+    monkeypatch.setattr(context, "_encoding_loaded", True)
+    monkeypatch.setattr(context, "_summaries", context.OrderedDict())
+    monkeypatch.setattr(context, "_summary_tasks", {})
+    context.count_tokens.cache_clear()
+    yield calls
+    context.count_tokens.cache_clear()
+
+def _turn(i: int, role: str) -> dict:
+    return {"role": role, "content": f"{i} 番目の発言です。設定ファイルと環境変数の読み込み順序を確認します。"}
+
+@pytest.mark.parametrize("settle_every", [1, 3])
+def test_summary_and_budget_across_block_boundaries(summarizing, settle_every):
+    """settle_every: 要約の生成が何ターンごとに終わるか（3 なら境界の要約がまだ無いターンがある）"""
+    async def run():
+        messages = [{"role": "system", "content": "あなたは丁寧なアシスタントです。"}]
+        summarized_turns = []
+        for turn in range(30):
+            messages.append(_turn(turn, "user"))
+            result = context.fit_context(messages)
+
+            assert context.count_message_tokens(result) <= MAX_TOKENS
+            assert result[-1] == messages[-1]
+            if len(result) < len(messages):
+                # 落とした場合でも、要約なしで 1 件だけになるような極端な切り詰めはしない
+                assert len([m for m in result if m["role"] != "system"]) >= 3
+                summarized_turns.append(any(m["content"].startswith("これまでの会話の要約") for m in result))
+
+            if turn % settle_every == 0:
+                await asyncio.gather(*list(context._summary_tasks.values()))
+            messages.append(_turn(turn, "assistant"))
+        return summarized_turns
+
+    summarized_turns = asyncio.run(run())
+    # 最初に履歴を落としたターンは要約がまだ無いが、一度できた後はブロック境界をまたいでも要約が付く
+    assert len(summarized_turns) > BLOCK
+    assert summarized_turns[0] is False
+    first = summarized_turns.index(True)
+    assert all(summarized_turns[first:])
+
+def test_fits_without_summary(summarizing, monkeypatch):
+    monkeypatch.setattr(context, "CONTEXT_SUMMARY_ENABLED", False)
+    messages = []
+    for turn in range(20):
+        messages += [_turn(turn, "user"), _turn(turn, "assistant")]
+    result = context.fit_context(messages)
+    assert context.count_message_tokens(result) <= MAX_TOKENS
+    assert result[-1] == messages[-1]
+    assert not summarizing
@@ -0,0 +1,94 @@
+# tests/test_tts_cache.py
+import asyncio
+import io
+import wave
+
+from app.services.tts_cache import TTSCache
+from app.services.tts_stream import stream_sentence_audio
+
+def _cache(tmp_path) -> TTSCache:
+    return TTSCache(tmp_path, max_entries=16, max_bytes=1024 * 1024, disk_max_bytes=1024 * 1024)
+
+def _wav(text: str) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(24000)
+        w.writeframes(text.encode("utf-8"))
+    return buf.getvalue()
+
+def test_last_waiter_cancel_stops_compute(tmp_path):
+    cache = _cache(tmp_path)
+    cancelled = []
+
+    async def compute() -> bytes:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return b"audio"
+
+    async def run():
+        waiter = asyncio.ensure_future(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert cancelled == [True]
+    assert cache.stats["cancelled"] == 1
+    assert cache.snapshot()["inflight"] == 0
+
+def test_remaining_waiter_keeps_compute(tmp_path):
+    cache = _cache(tmp_path)
+
+    async def compute() -> bytes:
+        await asyncio.sleep(0.05)
+        return b"audio"
+
+    async def run():
+        first = asyncio.ensure_future(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(cache.get_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, await cache.get("k")
+
+    (data, status), cached = asyncio.run(run())
+    assert (data, status) == (b"audio", "coalesced")
+    assert cached == (b"audio", "memory")
+    assert cache.stats["cancelled"] == 0
+
+def test_stream_disconnect_cancels_pending_syntheses(tmp_path):
+    cache = _cache(tmp_path)
+    started, finished = [], []
+
+    async def synthesize(sentence: str) -> bytes:
+        async def compute() -> bytes:
+            started.append(sentence)
+            await asyncio.sleep(0.05 if sentence == "1" else 10)
+            finished.append(sentence)
+            return _wav(sentence)
+
+        data, _ = await cache.get_or_compute(sentence, compute)
+        return data
+
+    async def sentences():
+        for i in range(1, 6):
+            yield str(i)
+
+    async def run():
+        stream = stream_sentence_audio(sentences(), synthesize, concurrency=3)
+        await stream.__anext__()  # ヘッダ
+        await stream.__anext__()  # 1 文目
+        await stream.aclose()  # クライアントの切断
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert finished == ["1"]
+    assert len(started) > 1
+    assert cache.stats["cancelled"] == len(started) - 1
+    assert cache.snapshot()["inflight"] == 0
@@ -0,0 +1,37 @@
+# tests/test_xlsx_patch.py
+import io
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from app.services.xlsx_patch import XlsxTemplate
+
+TEMPLATE_PATH = Path(__file__).parent.parent / "template.xlsx"
+
+def _values(i: int) -> dict:
+    # 出力ごとに内容（= サイズと CRC）が変わるようにする
+    return {"B1": 2024, "E1": i % 12 + 1, "D6": "社員" * (i % 7 + 1), "D11": i / 10000}
+
+def test_concurrent_renders_produce_valid_archives():
+    """ATTENDANCE_EXECUTOR=thread と同じく 1 つのテンプレートを複数スレッドで同時に使う"""
+    template = XlsxTemplate(TEMPLATE_PATH.read_bytes())
+    # スレッドの切り替えを頻繁にして競合を起こしやすくする
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            outputs = list(pool.map(template.render, (_values(i) for i in range(1000))))
+    finally:
+        sys.setswitchinterval(interval)
+
+    for i, data in enumerate(outputs):
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            assert z.testzip() is None, f"render {i} is corrupt"
+            sheet = z.read(template.sheet_path).decode("utf-8")
+            assert "社員" * (i % 7 + 1) + "<" in sheet
+
+def test_render_keeps_template_members():
+    template = XlsxTemplate(TEMPLATE_PATH.read_bytes())
+    with zipfile.ZipFile(TEMPLATE_PATH) as src, zipfile.ZipFile(io.BytesIO(template.render(_values(0)))) as out:
+        assert sorted(src.namelist()) == sorted(out.namelist())